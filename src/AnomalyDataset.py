@@ -9,17 +9,49 @@ from torch.utils.data.dataset import Dataset
 from torch.utils.data.dataloader import DataLoader
 
 
+def packed_dir(root_dir, image_size):
+    '''Folder of the images of a dataset packed at image_size.'''
+    return os.path.join(root_dir, f'packed_{image_size}')
+
+
+def pack_dataset(root_dir, image_size):
+    '''Decode and resize once every image and ground truth of a dataset,
+    for AnomalyDataset(..., packed_size=image_size). They are written as
+    uint8 arrays (N, image_size, image_size, 3) and (N, image_size, image_size)
+    in images.npy and gt.npy, row i being the i-th entry of index.csv.
+    The resizing is the one of transforms.Resize.'''
+    dataset = AnomalyDataset(root_dir,
+                             transform=transforms.Resize((image_size, image_size)),
+                             gt_transform=transforms.Resize((image_size, image_size)))
+    out_dir = packed_dir(root_dir, image_size)
+    os.makedirs(out_dir, exist_ok=True)
+    shape = (len(dataset), image_size, image_size)
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+', dtype=np.uint8, shape=shape + (3,))
+    gts = np.lib.format.open_memmap(os.path.join(out_dir, 'gt.npy'), mode='w+', dtype=np.uint8, shape=shape)
+    for i in range(len(dataset)):
+        sample = dataset[i]
+        images[i] = np.asarray(sample['image'].convert('RGB'))
+        gts[i] = np.asarray(sample['gt'].convert('L'))
+    images.flush()
+    gts.flush()
+    dataset.frame_list.assign(row=range(len(dataset))).to_csv(os.path.join(out_dir, 'index.csv'), index=False)
+    return out_dir
+
+
 class AnomalyDataset(Dataset):
     '''Anomaly detection dataset.
     - root_dir: path to the dataset to train the model on, eg: <path>/data/carpet
     - transform: list of transformation to apply on input image, eg: Resize, Normalize, etc
     - gt_transform: list of transformation to apply on gt image, eg: Resize.
+    - packed_size: read the images packed at this size by pack_dataset (packed on
+                   first use) instead of decoding the PNG files, None for the PNG files.
+                   The transforms get the same PIL images, already resized.
     - constraint: filter to apply on the reading of the CSV file, a filter is a kwarg.
                   eg: type='train' to filter train data
                       label=0 to filter on anomaly-free data
     '''
 
-    def __init__(self, root_dir, transform=transforms.ToTensor(), gt_transform=transforms.ToTensor(), **constraint):
+    def __init__(self, root_dir, transform=transforms.ToTensor(), gt_transform=transforms.ToTensor(), packed_size=None, **constraint):
         super(AnomalyDataset, self).__init__()
         self.root_dir = root_dir
         self.transform = transform
@@ -28,6 +60,15 @@ class AnomalyDataset(Dataset):
         self.gt_dir = os.path.join(self.root_dir, 'ground_truth')
         self.dataset = self.root_dir.split('/')[-1]
         self.csv_file =  os.path.join(self.root_dir, self.dataset + '.csv')
+        self.packed_dir = None
+        if packed_size:
+            self.packed_dir = packed_dir(self.root_dir, packed_size)
+            if not os.path.exists(os.path.join(self.packed_dir, 'index.csv')):
+                print(f'Packing {self.root_dir} at {packed_size}x{packed_size} into {self.packed_dir}...')
+                pack_dataset(self.root_dir, packed_size)
+            self.csv_file = os.path.join(self.packed_dir, 'index.csv')
+        # memory maps are opened on first access, in each DataLoader worker
+        self.images, self.gts = None, None
         self.frame_list = self._get_dataset(self.csv_file, constraint)
     
     def _get_dataset(self, csv_file, constraint):
@@ -39,11 +80,34 @@ class AnomalyDataset(Dataset):
     def __len__(self):
         return len(self.frame_list)
 
+    def __getstate__(self):
+        # DataLoader workers open their own memory maps instead of a pickled copy
+        state = self.__dict__.copy()
+        state['images'], state['gts'] = None, None
+        return state
+
+    def _get_packed(self, item):
+        '''Image and ground truth of a packed dataset, read without decoding.'''
+        if self.images is None:
+            self.images = np.load(os.path.join(self.packed_dir, 'images.npy'), mmap_mode='r')
+            self.gts = np.load(os.path.join(self.packed_dir, 'gt.npy'), mmap_mode='r')
+        row = item['row']
+        return Image.fromarray(self.images[row], 'RGB'), Image.fromarray(self.gts[row], 'L')
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
         item = self.frame_list.iloc[idx]
+        if self.packed_dir:
+            image, gt = self._get_packed(item)
+            sample = {'label': item['label']}
+            if self.transform:
+                sample['image'] = self.transform(image)
+            if self.gt_transform:
+                sample['gt'] = self.gt_transform(gt)
+            return sample
+
         img_path = os.path.join(self.img_dir, item['image_name'])
         label = self.frame_list.iloc[idx]['label']
         image = Image.open(img_path)
@@ -1,8 +1,11 @@
+import math
 import torch
 import pytorch_lightning as pl
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.quantized as nnq
 import torchvision.models as models
-from FDFE import multiPoolPrepare, multiMaxPooling, unwrapPrepare, unwrapPool
+from FDFE import multiPoolPrepare, stridedMultiMaxPooling, unwrapShuffle
 
 
 class AnomalyNet:
@@ -22,10 +25,51 @@ class AnomalyNet:
         return model()
 
 
-class AnomalyNet65(pl.LightningModule):
+def conv_layers(net):
+    '''Convolutions of a patch CNN (or of an ensemble), in order.'''
+    return [module for module in net.modules() if isinstance(module, (nn.Conv2d, nnq.Conv2d))]
+
+
+def atrous_features(net, x):
+    '''Dense (b, h, w, c) output of the convolutions of a patch CNN, where
+    every stride-2 max pooling is replaced by a stride-1 pooling and the
+    following layers are dilated accordingly (algorithme a trous).
+    Same values as FDFE, without sub-batches nor unwrapping.'''
+
+    imH = x.size(2)
+    imW = x.size(3)
+
+    x = net.multiPoolPrepare(x)
+
+    dilation = 1
+    for i, conv in enumerate(conv_layers(net)):
+        x = net.l_relu(F.conv2d(x, conv.weight, conv.bias, dilation=dilation, groups=conv.groups))
+        if i < net.n_pools:
+            x = F.max_pool2d(x, 2, stride=1, dilation=dilation)
+            dilation *= 2
+
+    # the last rows/cols only exist because the patch is wider than
+    # the receptive field of the poolings
+    return x[:, :, :imH, :imW].permute(0, 2, 3, 1)
+
+
+class AtrousMixin:
+    '''atrous method of the patch CNNs, see atrous_features.'''
+
+    def atrous(self, x):
+        '''Dense evaluation of the patch CNN on a whole image with
+        dilated convolutions and poolings, alternative to fdfe.'''
+
+        y = atrous_features(self, x)
+        y = self.l_relu(self.decode(y))
+        return y
+
+
+class AnomalyNet65(AtrousMixin, pl.LightningModule):
     '''Patch-based CNN for anomaly detection. Designed to work with patches of size 65x65.
     '''
     size = 65
+    n_pools = 3
 
     def __init__(self):
         super(AnomalyNet65, self).__init__()
@@ -45,8 +89,8 @@ class AnomalyNet65(pl.LightningModule):
         self.dropout = nn.Dropout(0.2)
         
         self.max_pool = nn.MaxPool2d(2, 2)
-        self.multiMaxPooling = multiMaxPooling(2, 2, 2, 2)
-        self.unwrapPrepare = unwrapPrepare()
+        self.multiMaxPooling = stridedMultiMaxPooling(2, 2, 2, 2)
+        self.unwrapShuffle = unwrapShuffle(3)
 
         self.l_relu = nn.LeakyReLU(5e-3)
 
@@ -57,11 +101,7 @@ class AnomalyNet65(pl.LightningModule):
         imH = x.size(2)
         imW = x.size(3)
 
-        unwrapPool3 = unwrapPool(self.outChans, imH / (2 * 2 * 2), imW / (2 * 2 * 2), 2, 2)
-        unwrapPool2 = unwrapPool(self.outChans, imH / (2 * 2), imW / (2 * 2), 2, 2)
-        unwrapPool1 = unwrapPool(self.outChans, imH / 2, imW / 2, 2, 2)
-
-        x = self.multiPoolPrepare(x)
+        x = self.multiPoolPrepare(x, 2**self.n_pools)
 
         x = self.l_relu(self.conv1(x))
         x = self.multiMaxPooling(x)
@@ -75,14 +115,8 @@ class AnomalyNet65(pl.LightningModule):
         x = self.l_relu(self.conv4(x))
         x = self.l_relu(self.conv5(x))
 
-        x = self.unwrapPrepare(x)
-        x = unwrapPool3(x)
-        x = unwrapPool2(x)
-        x = unwrapPool1(x)
-
-        y = x.view(self.outChans, imH, imW, -1)
-        y = y.permute(3, 1, 2, 0)
-        y = self.l_relu(self.decode(y))
+        x = self.unwrapShuffle(x, imH, imW)
+        y = self.l_relu(self.decode(x))
         return y
 
     def forward(self, x, fdfe=False):
@@ -106,10 +140,11 @@ class AnomalyNet65(pl.LightningModule):
             return x
 
 
-class AnomalyNet33(pl.LightningModule):
+class AnomalyNet33(AtrousMixin, pl.LightningModule):
     '''Patch-based CNN for anomaly detection. Designed to work with patches of size 33x33.
     '''
     size = 33
+    n_pools = 2
 
     def __init__(self):
         super(AnomalyNet33, self).__init__()
@@ -128,8 +163,8 @@ class AnomalyNet33(pl.LightningModule):
         self.dropout = nn.Dropout(0.2)
         
         self.max_pool = nn.MaxPool2d(2, 2)
-        self.multiMaxPooling = multiMaxPooling(2, 2, 2, 2)
-        self.unwrapPrepare = unwrapPrepare()
+        self.multiMaxPooling = stridedMultiMaxPooling(2, 2, 2, 2)
+        self.unwrapShuffle = unwrapShuffle(2)
 
         self.l_relu = nn.LeakyReLU(5e-3)
 
@@ -140,10 +175,7 @@ class AnomalyNet33(pl.LightningModule):
         imH = x.size(2)
         imW = x.size(3)
 
-        unwrapPool2 = unwrapPool(self.outChans, imH / (2 * 2), imW / (2 * 2), 2, 2)
-        unwrapPool1 = unwrapPool(self.outChans, imH / 2, imW / 2, 2, 2)
-
-        x = self.multiPoolPrepare(x)
+        x = self.multiPoolPrepare(x, 2**self.n_pools)
 
         x = self.l_relu(self.conv1(x))
         x = self.multiMaxPooling(x)
@@ -154,13 +186,8 @@ class AnomalyNet33(pl.LightningModule):
         x = self.l_relu(self.conv3(x))
         x = self.l_relu(self.conv4(x))
 
-        x = self.unwrapPrepare(x)
-        x = unwrapPool2(x)
-        x = unwrapPool1(x)
-
-        y = x.view(self.outChans, imH, imW, -1)
-        y = y.permute(3, 1, 2, 0)
-        y = self.l_relu(self.decode(y))
+        x = self.unwrapShuffle(x, imH, imW)
+        y = self.l_relu(self.decode(x))
         return y
 
     def forward(self, x, fdfe=False):
@@ -182,10 +209,11 @@ class AnomalyNet33(pl.LightningModule):
             return x
 
 
-class AnomalyNet17(pl.LightningModule):
+class AnomalyNet17(AtrousMixin, pl.LightningModule):
     '''Patch-based CNN for anomaly detection. Designed to work with patches of size 17x17
     '''
     size = 17
+    n_pools = 0
 
     def __init__(self):
         super(AnomalyNet17, self).__init__()
@@ -209,9 +237,6 @@ class AnomalyNet17(pl.LightningModule):
         '''Use Fast Dense Feature Extraction to efficiently apply 
         the patch-based CNN AnomalyNet17 on a whole image.'''
 
-        imH = x.size(2)
-        imW = x.size(3)
-
         x = self.multiPoolPrepare(x)
 
         x = self.l_relu(self.conv1(x))
@@ -219,8 +244,7 @@ class AnomalyNet17(pl.LightningModule):
         x = self.l_relu(self.conv3(x))
         x = self.l_relu(self.conv4(x))
 
-        y = x.view(self.outChans, imH, imW, -1)
-        y = y.permute(3, 1, 2, 0)
+        y = x.permute(0, 2, 3, 1)
         y = self.l_relu(self.decode(y))
         return y
 
@@ -241,6 +265,127 @@ class AnomalyNet17(pl.LightningModule):
             return x
 
 
+class EnsembleAnomalyNet(nn.Module):
+    '''M patch-based CNNs of the same patch size packed into a single network.
+    The first convolution stacks the filters of every network, the following
+    ones are grouped convolutions (one group per network) and the decode
+    layers are applied as one batched matrix product.
+    fdfe returns the (b, M, h, w, 512) descriptors of the M networks.
+    '''
+
+    def __init__(self, patch_size, n_nets):
+        super(EnsembleAnomalyNet, self).__init__()
+        template = AnomalyNet.create((patch_size, patch_size))
+        self.size = template.size
+        self.n_pools = template.n_pools
+        self.n_nets = n_nets
+        self.pH = template.pH
+        self.pW = template.pW
+        self.outChans = template.outChans
+        self.multiPoolPrepare = template.multiPoolPrepare
+
+        convs = []
+        for i, conv in enumerate(conv_layers(template)):
+            groups = 1 if i == 0 else n_nets
+            convs.append(nn.Conv2d(conv.in_channels * groups, conv.out_channels * n_nets,
+                                   conv.kernel_size, conv.stride, groups=groups))
+        self.convs = nn.ModuleList(convs)
+        self.decode_weight = nn.Parameter(torch.empty(n_nets, template.decode.in_features, template.decode.out_features))
+        self.decode_bias = nn.Parameter(torch.empty(n_nets, 1, template.decode.out_features))
+        self.reset_decode()
+
+        if self.n_pools:
+            self.multiMaxPooling = stridedMultiMaxPooling(2, 2, 2, 2)
+            self.unwrapShuffle = unwrapShuffle(self.n_pools)
+
+        self.l_relu = nn.LeakyReLU(5e-3)
+
+    def reset_decode(self):
+        '''Initialize the decode layer of every network as nn.Linear does.'''
+        bound = 1 / math.sqrt(self.decode_weight.size(1))
+        with torch.no_grad():
+            for weight, bias in zip(self.decode_weight, self.decode_bias):
+                nn.init.kaiming_uniform_(weight.t(), a=math.sqrt(5))
+                nn.init.uniform_(bias, -bound, bound)
+
+    @classmethod
+    def from_nets(cls, nets):
+        '''Pack trained AnomalyNet of the same patch size, eg: the students.'''
+        self = cls(nets[0].size, len(nets))
+        with torch.no_grad():
+            for i, conv in enumerate(self.convs):
+                conv.weight.copy_(torch.cat([conv_layers(net)[i].weight for net in nets]))
+                conv.bias.copy_(torch.cat([conv_layers(net)[i].bias for net in nets]))
+            self.decode_weight.copy_(torch.stack([net.decode.weight.t() for net in nets]))
+            self.decode_bias.copy_(torch.stack([net.decode.bias[None] for net in nets]))
+        return self
+
+    def fdfe(self, x):
+        '''Fast Dense Feature Extraction of the M networks at once.'''
+
+        imH = x.size(2)
+        imW = x.size(3)
+
+        x = self.multiPoolPrepare(x, 2**self.n_pools)
+
+        for i, conv in enumerate(self.convs):
+            x = self.l_relu(conv(x))
+            if i < self.n_pools:
+                x = self.multiMaxPooling(x)
+
+        if self.n_pools:
+            x = self.unwrapShuffle(x, imH, imW)
+        else:
+            x = x.permute(0, 2, 3, 1)
+
+        return self.decode(x)
+
+    def atrous(self, x):
+        '''Dense evaluation of the M networks with dilated convolutions
+        and poolings, alternative to fdfe.'''
+        return self.decode(atrous_features(self, x))
+
+    def decode(self, x):
+        # (b, h, w, M * c) -> (M, b * h * w, c) -> (b, M, h, w, 512)
+        b, imH, imW = x.size(0), x.size(1), x.size(2)
+        x = x.reshape(-1, self.n_nets, self.outChans).transpose(0, 1)
+        y = self.l_relu(torch.baddbmm(self.decode_bias, x, self.decode_weight))
+        y = y.view(self.n_nets, b, imH, imW, -1).transpose(0, 1)
+        return y
+
+    def forward(self, x):
+        return self.fdfe(x)
+
+
+class DeployedAnomalyNet(nn.Module):
+    '''Teacher whose descriptors are normalized by a final per-channel affine
+    layer, (y - mu) / sqrt(var) folded into y * scale + shift at load time.
+    - net: AnomalyNet, or any network with the fdfe/atrous interface
+    - mu, var: calibration mean and variance of the 512 descriptors
+    '''
+
+    def __init__(self, net, mu, var):
+        super(DeployedAnomalyNet, self).__init__()
+        self.net = net
+        self.size = net.size
+        self.n_pools = net.n_pools
+        self.pH = net.pH
+        self.pW = net.pW
+        self.multiPoolPrepare = net.multiPoolPrepare
+        scale = 1 / torch.sqrt(torch.as_tensor(var, dtype=torch.float32))
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', -torch.as_tensor(mu, dtype=torch.float32) * scale)
+
+    def fdfe(self, x):
+        return torch.addcmul(self.shift, self.net.fdfe(x), self.scale)
+
+    def atrous(self, x):
+        return torch.addcmul(self.shift, self.net.atrous(x), self.scale)
+
+    def forward(self, x):
+        return self.fdfe(x)
+
+
 if __name__ == '__main__':
 
     pH = 33
@@ -0,0 +1,102 @@
+import torch
+import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
+from AnomalyNet import EnsembleAnomalyNet
+from anomaly_detection import get_tiled_score_map, deploy
+from utils import autocast
+
+
+class PackedAnomalyNet(nn.Module):
+    '''A single patch CNN stored as a plain nn.Module (an EnsembleAnomalyNet
+    of one network), so that it can be traced, exported or quantized.'''
+
+    def __init__(self, net):
+        super(PackedAnomalyNet, self).__init__()
+        self.net = EnsembleAnomalyNet.from_nets([net])
+        self.size = self.net.size
+        self.n_pools = self.net.n_pools
+        self.pH = self.net.pH
+        self.pW = self.net.pW
+        self.multiPoolPrepare = self.net.multiPoolPrepare
+
+    def fdfe(self, x):
+        return self.net.fdfe(x)[:, 0]
+
+    def atrous(self, x):
+        return self.net.atrous(x)[:, 0]
+
+
+class AnomalyScorer(nn.Module):
+    '''Teacher, students and calibration parameters in one module,
+    inputs (b, 3, h, w) -> anomaly score map (b, h, w).
+    - teacher: AnomalyNet
+    - students: list of AnomalyNet or EnsembleAnomalyNet
+    - params: calibration parameters, see anomaly_detection.calibrate
+    - max_memory, engine: see anomaly_detection.get_tiled_score_map
+    '''
+
+    def __init__(self, teacher, students, params, max_memory=None, engine='fdfe'):
+        super(AnomalyScorer, self).__init__()
+        # teacher normalization and score standardization are constants of the graph
+        self.teacher, self.params = deploy(PackedAnomalyNet(teacher), params)
+        if not isinstance(students, EnsembleAnomalyNet):
+            students = EnsembleAnomalyNet.from_nets(students)
+        self.students = students
+        self.max_memory = max_memory
+        self.engine = engine
+
+    def forward(self, x):
+        return get_tiled_score_map(x, self.teacher, self.students, self.params, self.max_memory, self.engine)
+
+
+class MultiScaleScorer:
+    '''Scores a batch with the networks of several patch sizes, eg: 17, 33
+    and 65, sharing the decoded and normalized input batch.
+    - models: {patch_size: (teacher, students, params)}, see anomaly_detection.deploy
+    - max_memory, engine: see anomaly_detection.get_tiled_score_map
+    - precision: 'fp32' or 'bf16', see utils.autocast
+    - n_workers: number of scales scored concurrently, 1 scores them in turn
+    The worker threads are released by close(), or at the end of a with block.
+    '''
+
+    def __init__(self, models, max_memory=None, engine='fdfe', precision='fp32', n_workers=1):
+        # largest networks first, they are the slowest
+        self.models = dict(sorted(models.items(), reverse=True))
+        self.max_memory = max_memory
+        self.engine = engine
+        self.precision = precision
+        self.executor = ThreadPoolExecutor(n_workers) if n_workers > 1 else None
+
+    def score_map(self, patch_size, inputs):
+        teacher, students, params = self.models[patch_size]
+        # autocast is thread local
+        with autocast(inputs.device, self.precision):
+            return get_tiled_score_map(inputs, teacher, students, params, self.max_memory, self.engine)
+
+    def __call__(self, inputs):
+        '''Averaged score map (b, h, w) and {patch_size: score map}.'''
+        if self.executor is None:
+            maps = {p: self.score_map(p, inputs) for p in self.models}
+        else:
+            futures = {p: self.executor.submit(self.score_map, p, inputs) for p in self.models}
+            maps = {p: future.result() for p, future in futures.items()}
+        return torch.stack(list(maps.values())).mean(dim=0), maps
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@torch.no_grad()
+def trace_scorer(scorer, example):
+    '''TorchScript version of an AnomalyScorer, specialized for the shape of
+    the example batch, with its weights and parameters frozen in the graph.'''
+    traced = torch.jit.trace(scorer.eval(), example, check_trace=False)
+    return torch.jit.freeze(traced)
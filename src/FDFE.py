@@ -1,6 +1,7 @@
 # Source:
 # https://github.com/erezposner/Fast_Dense_Feature_Extraction
 
+from functools import lru_cache
 from torch import nn
 import torch
 import numpy as np
@@ -21,8 +22,12 @@ class multiPoolPrepare(nn.Module):
         self.pad_left = np.ceil(padx / 2).astype(int)
         self.pad_right = np.floor(padx / 2).astype(int)
 
-    def forward(self, x):
-        y = F.pad(x, [self.pad_left, self.pad_right, self.pad_top, self.pad_bottom], value=0)
+    def forward(self, x, stride=1):
+        # zeros are added at the bottom/right so that the image size
+        # is a multiple of the stride of the poolings
+        extra_h = -x.size(2) % stride
+        extra_w = -x.size(3) % stride
+        y = F.pad(x, [self.pad_left, self.pad_right + extra_w, self.pad_top, self.pad_bottom + extra_h], value=0)
         return y
 
 
@@ -53,6 +58,42 @@ class unwrapPool(nn.Module):
         return y.contiguous()
 
 
+@lru_cache(maxsize=None)
+def unwrapIndex(nPools, imH, imW, dH=2, dW=2):
+    '''Crop size and permutation mapping the FDFE sub-batches back to pixels.
+
+    After nPools multiMaxPooling stages the sub-batch index splits into
+    (i_n, j_n, ..., i_1, j_1, n) where (i_k, j_k) is the shift of stage k,
+    and pixel row r = y * dH**nPools + (i_n ... i_1) in base dH (same for
+    the columns with the j_k). Images whose size is not a multiple of the
+    stride were padded by multiPoolPrepare, hence the rounding up.
+    Computed once per image size.
+    '''
+    h, w = -(-imH // dH**nPools), -(-imW // dW**nPools)
+    n, c, y, x = 2 * nPools, 2 * nPools + 1, 2 * nPools + 2, 2 * nPools + 3
+    permutation = (n, y) + tuple(range(0, 2 * nPools, 2)) + (x,) + tuple(range(1, 2 * nPools, 2)) + (c,)
+    return h, w, permutation
+
+
+class unwrapShuffle(nn.Module):
+    '''Replaces unwrapPrepare followed by the chain of unwrapPool:
+    (dH**nPools * dW**nPools * N, C, h + 1, w + 1) -> (N, imH, imW, C)
+    with a single permuted copy.
+    '''
+    def __init__(self, nPools, dW=2, dH=2):
+        super(unwrapShuffle, self).__init__()
+        self.nPools = int(nPools)
+        self.dW = int(dW)
+        self.dH = int(dH)
+
+    def forward(self, x, imH, imW):
+        h, w, permutation = unwrapIndex(self.nPools, imH, imW, self.dH, self.dW)
+        C = x.size(1)
+        y = x[:, :, :h, :w].reshape((self.dH, self.dW) * self.nPools + (-1, C, h, w))
+        y = y.permute(permutation).reshape(-1, h * self.dH**self.nPools, w * self.dW**self.nPools, C)
+        return y[:, :imH, :imW]
+
+
 class multiMaxPooling(nn.Module):
     def __init__(self, kW, kH, dW, dH):
         super(multiMaxPooling, self).__init__()
@@ -92,6 +133,53 @@ class multiMaxPooling(nn.Module):
         return torch.cat(res, 0)
 
 
+class stridedMultiMaxPooling(nn.Module):
+    '''Drop-in replacement for multiMaxPooling.
+
+    A single stride-1 max pooling pass computes every window once, each
+    shifted output is then a strided view of that result which is written
+    straight into the preallocated (dH*dW*N, C, h, w) output, with the same
+    zero borders and sub-batch order as multiMaxPooling.
+    '''
+    def __init__(self, kW, kH, dW, dH):
+        super(stridedMultiMaxPooling, self).__init__()
+        # same (quirky) argument order as multiMaxPooling / nn.MaxPool2d
+        self.kernel_size = (kW, kH)
+        self.stride = (dW, dH)
+        self.padd = [(j, i) for i in range(0, dH) for j in range(0, dW)]
+
+    def forward(self, x):
+        kernel_h, kernel_w = self.kernel_size
+        stride_h, stride_w = self.stride
+        N, C, H, W = x.size()
+
+        # every window position, shifts are recovered by striding over it
+        m = F.max_pool2d(x, kernel_size=self.kernel_size, stride=1)
+
+        sizes = [((H - 2 * i - kernel_h) // stride_h + 1, (W - 2 * j - kernel_w) // stride_w + 1)
+                 for j, i in self.padd]
+        max_h = max(h for h, _ in sizes)
+        max_w = max(w for _, w in sizes)
+
+        if torch.onnx.is_in_onnx_export():
+            # in-place writes export as ScatterND with (N, C, h, w, 4) indices,
+            # padded shifts are concatenated instead
+            res = []
+            for (j, i), (h, w) in zip(self.padd, sizes):
+                top = (max_h - h) // 2
+                left = (max_w - w) // 2
+                _x = m[:, :, i:i + (h - 1) * stride_h + 1:stride_h, j:j + (w - 1) * stride_w + 1:stride_w]
+                res.append(F.pad(_x, [left, max_w - w - left, top, max_h - h - top], value=0))
+            return torch.cat(res, 0)
+
+        y = x.new_zeros((len(self.padd) * N, C, max_h, max_w))
+        for n, ((j, i), (h, w)) in enumerate(zip(self.padd, sizes)):
+            top = (max_h - h) // 2
+            left = (max_w - w) // 2
+            y[n * N:(n + 1) * N, :, top:top + h, left:left + w] = \
+                m[:, :, i:i + (h - 1) * stride_h + 1:stride_h, j:j + (w - 1) * stride_w + 1:stride_w]
+        return y
+
 
 class multiConv(nn.Module):
     def __init__(self, nInputPlane, nOutputPlane, kW, kH, dW, dH):
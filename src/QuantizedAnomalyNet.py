@@ -0,0 +1,87 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from AnomalyNet import conv_layers
+
+
+class QuantizedAnomalyNet(nn.Module):
+    '''Patch CNN prepared for INT8 post-training static quantization (CPU).
+    The dense output is computed as in atrous_features: the convolutions are
+    dilated after each pooling, which only leaves quantizable modules
+    (Conv2d, LeakyReLU) and max poolings on the int8 path. The decode layer
+    stays in fp32: an int8 output would round the small descriptor values
+    to a constant, and a dynamically quantized one would take its input
+    scale from the whole batch, making a descriptor depend on the tile and
+    on the other images.
+    fdfe and atrous both return the dense (b, h, w, 512) descriptors.
+    '''
+
+    def __init__(self, net):
+        super(QuantizedAnomalyNet, self).__init__()
+        self.size = net.size
+        self.n_pools = net.n_pools
+        self.pH = net.pH
+        self.pW = net.pW
+        self.multiPoolPrepare = net.multiPoolPrepare
+
+        convs = []
+        dilation = 1
+        for i, conv in enumerate(conv_layers(net)):
+            conv = copy.deepcopy(conv)
+            conv.dilation = (dilation, dilation)
+            convs.append(conv)
+            if i < self.n_pools:
+                dilation *= 2
+        self.convs = nn.ModuleList(convs)
+        self.decode = copy.deepcopy(net.decode)
+
+        # one activation per layer, each gets its own quantization parameters
+        self.l_relus = nn.ModuleList([nn.LeakyReLU(5e-3) for _ in range(len(convs))])
+        self.l_relu = nn.LeakyReLU(5e-3)
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        imH = x.size(2)
+        imW = x.size(3)
+
+        x = self.quant(self.multiPoolPrepare(x))
+
+        for i, conv in enumerate(self.convs):
+            x = self.l_relus[i](conv(x))
+            if i < self.n_pools:
+                x = F.max_pool2d(x, 2, stride=1, dilation=conv.dilation[0])
+
+        x = self.dequant(x[:, :, :imH, :imW]).permute(0, 2, 3, 1)
+        y = self.l_relu(self.decode(x))
+        return y
+
+    def fdfe(self, x):
+        return self.forward(x)
+
+    def atrous(self, x):
+        return self.forward(x)
+
+
+@torch.no_grad()
+def quantize_net(net, calibration_batches=None):
+    '''INT8 copy of a trained AnomalyNet, its activation ranges being
+    observed on calibration_batches (iterable of (b, 3, h, w) images).
+    Without calibration data, only the structure is built, ready to load
+    a quantized state_dict. The weights are packed for the current
+    torch.backends.quantized.engine, which the entry points set.'''
+    qnet = QuantizedAnomalyNet(net.cpu()).eval()
+    qnet.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    qnet.decode.qconfig = None
+    qnet.l_relu.qconfig = None
+    prepare(qnet, inplace=True)
+    if calibration_batches is None:
+        # observers need one pass to produce quantization parameters
+        qnet(torch.zeros((1, 3, qnet.pH, qnet.pW)))
+    else:
+        for inputs in calibration_batches:
+            qnet(inputs.cpu())
+    convert(qnet, inplace=True)
+    return qnet
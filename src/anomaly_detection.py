@@ -1,14 +1,17 @@
+import time
 import torch
+import torch.nn.functional as F
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from argparse import ArgumentParser
-from einops import rearrange, reduce
-from AnomalyNet import AnomalyNet
+from einops import rearrange
+from AnomalyNet import EnsembleAnomalyNet, DeployedAnomalyNet
 from AnomalyDataset import AnomalyDataset
 from torchvision import transforms
 from torch.utils.data.dataloader import DataLoader
-from utils import increment_mean_and_var, load_model
+from utils import increment_mean_and_var, load_models, autocast
+from tiling import image_tiles, roi_mask
 import os
 from sklearn.metrics import roc_curve, auc
 
@@ -21,8 +24,12 @@ def parse_arguments():
     parser.add_argument('--test_size', type=int, default=20, help="Number of batch for the test set")
     parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
     parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
-    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--image_size', type=int, default=256, help="Size images are resized to, 0 keeps their native size")
     parser.add_argument('--visualize', type=bool, default=True, help="Display anomaly map batch per batch")
+    parser.add_argument('--fused_students', action='store_true', help="Run the students as one grouped network")
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--engine', type=str, default='fdfe', choices=['fdfe', 'atrous'], help="Dense evaluation of the patch CNNs")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help="Run the networks in bfloat16 with autocast, scores and statistics stay in fp32")
 
     # trainer arguments
     parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
@@ -33,31 +40,49 @@ def parse_arguments():
     return args
 
 
-def get_error_map(students_pred, teacher_pred):
-    # student: (batch, student_id, h, w, vector)
-    # teacher: (batch, h, w, vector)
-    mu_students = reduce(students_pred, 'b id h w vec -> b h w vec', 'mean')
-    err = reduce((mu_students - teacher_pred)**2, 'b h w vec -> b h w', 'sum')
-    return err
+def get_students_preds(students, inputs, engine='fdfe'):
+    # students: list of AnomalyNet or EnsembleAnomalyNet
+    # engine: dense evaluation method of the networks, 'fdfe' or 'atrous'
+    # output: the (batch, h, w, vector) predictions, one student at a time
+    if isinstance(students, EnsembleAnomalyNet):
+        yield from getattr(students, engine)(inputs).unbind(dim=1)
+    else:
+        for student in students:
+            yield getattr(student, engine)(inputs)
 
 
-def get_variance_map(students_pred):
-    # student: (batch, student_id, h, w, vector)
-    sse = reduce(students_pred**2, 'b id h w vec -> b id h w', 'sum')
-    msse = reduce(sse, 'b id h w -> b h w', 'mean')
-    mu_students = reduce(students_pred, 'b id h w vec -> b h w vec', 'mean')
-    var = msse - reduce(mu_students**2, 'b h w vec -> b h w', 'sum')
-    return var
+def get_error_and_variance_maps(students_preds, teacher_pred):
+    # students: iterable of (batch, h, w, vector), one per student
+    # teacher: (batch, h, w, vector)
+    # output: err and var maps (batch, h, w) in float32, from running sums of
+    # the student predictions and of their squared norms, so that only one
+    # student map is alive at a time.
+    sum_s = sum_sq = None
+    n = 0
+    for s in students_preds:
+        s_sq = torch.linalg.vector_norm(s, dim=-1, dtype=torch.float32)**2
+        if sum_s is None:
+            sum_s, sum_sq = s.float(), s_sq
+        else:
+            sum_s += s
+            sum_sq += s_sq
+        n += 1
+        del s
+    mu_students = sum_s.div_(n)
+    var = sum_sq / n - torch.linalg.vector_norm(mu_students, dim=-1)**2
+    err = torch.linalg.vector_norm(mu_students.sub_(teacher_pred), dim=-1)**2
+    return err, var
 
 
 @torch.no_grad()
-def calibrate(teacher, students, dataloader, device):
+def calibrate(teacher, students, dataloader, device, max_memory=None, engine='fdfe'):
     print('calibrating teacher on Student dataset.')
     t_mu, t_var, t_N = 0, 0, 0
     for _, batch in tqdm(enumerate(dataloader)):
         inputs = batch['image'].to(device)
-        t_out = teacher.fdfe(inputs)
-        t_mu, t_var, t_N = increment_mean_and_var(t_mu, t_var, t_N, t_out)
+        for (rows, cols), _, (crop_rows, crop_cols) in image_tiles(inputs, teacher, students, max_memory):
+            t_out = getattr(teacher, engine)(inputs[:, :, rows, cols])[:, crop_rows, crop_cols]
+            t_mu, t_var, t_N = increment_mean_and_var(t_mu, t_var, t_N, t_out)
     
     print('calibrating scoring parameters on Student dataset.')
     max_err, max_var = 0, 0
@@ -67,16 +92,16 @@ def calibrate(teacher, students, dataloader, device):
     for _, batch in tqdm(enumerate(dataloader)):
         inputs = batch['image'].to(device)
 
-        t_out = (teacher.fdfe(inputs) - t_mu) / torch.sqrt(t_var)
-        s_out = torch.stack([student.fdfe(inputs) for student in students], dim=1)
-
-        s_err = get_error_map(s_out, t_out)
-        s_var = get_variance_map(s_out)
-        mu_err, var_err, N_err = increment_mean_and_var(mu_err, var_err, N_err, s_err)
-        mu_var, var_var, N_var = increment_mean_and_var(mu_var, var_var, N_var, s_var)
+        for (rows, cols), _, (crop_rows, crop_cols) in image_tiles(inputs, teacher, students, max_memory):
+            tile = inputs[:, :, rows, cols]
+            t_out = (getattr(teacher, engine)(tile) - t_mu) / torch.sqrt(t_var)
+            s_err, s_var = get_error_and_variance_maps(get_students_preds(students, tile, engine), t_out)
+            s_err, s_var = s_err[:, crop_rows, crop_cols], s_var[:, crop_rows, crop_cols]
+            mu_err, var_err, N_err = increment_mean_and_var(mu_err, var_err, N_err, s_err)
+            mu_var, var_var, N_var = increment_mean_and_var(mu_var, var_var, N_var, s_var)
 
-        max_err = max(max_err, torch.max(s_err))
-        max_var = max(max_var, torch.max(s_var))
+            max_err = max(max_err, torch.max(s_err))
+            max_var = max(max_var, torch.max(s_var))
     
     return {"teacher": {"mu": t_mu, "var": t_var},
             "students": {"err":
@@ -87,19 +112,181 @@ def calibrate(teacher, students, dataloader, device):
             }
 
 
-@torch.no_grad()
-def get_score_map(inputs, teacher, students, params):
-    t_out = (teacher.fdfe(inputs) - params['teacher']['mu']) / torch.sqrt(params['teacher']['var'])
-    s_out = torch.stack([student.fdfe(inputs) for student in students], dim=1)
+def deploy(teacher, params):
+    '''Teacher with the calibration normalization folded into a final affine
+    layer, and params with the standardization of the score precomputed:
+    score = err * err_scale + var * var_scale + shift.
+    get_score_map then does no per-call normalization, same score maps.'''
+    teacher = DeployedAnomalyNet(teacher, params['teacher']['mu'], params['teacher']['var'])
+    err, var = params['students']['err'], params['students']['var']
+    err_scale, var_scale = 1 / torch.sqrt(err['var']), 1 / torch.sqrt(var['var'])
+    score = {'err_scale': err_scale, 'var_scale': var_scale, 'shift': -err['mu'] * err_scale - var['mu'] * var_scale}
+    return teacher, dict(params, score=score)
+
+
+def get_max_score(params):
+    # score of the most anomalous pixel of the calibration images
+    return ((params['students']['err']['max'] - params['students']['err']['mu']) / torch.sqrt(params['students']['err']['var'])
+            + (params['students']['var']['max'] - params['students']['var']['mu']) / torch.sqrt(params['students']['var']['var'])).item()
+
+
+def get_min_score(params):
+    # score of a pixel where the students match the teacher and agree,
+    # below the score of any anomaly-free pixel
+    return (-params['students']['err']['mu'] / torch.sqrt(params['students']['err']['var'])
+            - params['students']['var']['mu'] / torch.sqrt(params['students']['var']['var'])).item()
+
+
+def get_teacher_pred(teacher, inputs, params, engine='fdfe'):
+    # teacher: AnomalyNet, or DeployedAnomalyNet with params from deploy
+    # output: normalized descriptors (batch, h, w, vector)
+    t_out = getattr(teacher, engine)(inputs)
+    if not isinstance(teacher, DeployedAnomalyNet):
+        t_out = (t_out - params['teacher']['mu']) / torch.sqrt(params['teacher']['var'])
+    return t_out
+
+
+def standardize(s_err, s_var, params):
+    # error and variance maps (batch, h, w) -> score map (batch, h, w)
+    if 'score' in params:
+        score = params['score']
+        return s_err * score['err_scale'] + s_var * score['var_scale'] + score['shift']
 
-    s_err = get_error_map(s_out, t_out)
-    s_var = get_variance_map(s_out)
     score_map = (s_err - params['students']['err']['mu']) / torch.sqrt(params['students']['err']['var'])\
                     + (s_var - params['students']['var']['mu']) / torch.sqrt(params['students']['var']['var'])
-    
     return score_map
 
 
+@torch.no_grad()
+def get_score_map(inputs, teacher, students, params, engine='fdfe'):
+    t_out = get_teacher_pred(teacher, inputs, params, engine)
+    s_err, s_var = get_error_and_variance_maps(get_students_preds(students, inputs, engine), t_out)
+    return standardize(s_err, s_var, params)
+
+
+@torch.no_grad()
+def get_progressive_score_map(inputs, teacher, students, params, z=None, min_students=2, engine='fdfe'):
+    '''Score map of a batch evaluating the students one at a time, with running
+    sums of their descriptors and of their squared norms. After min_students,
+    an image stops once its max score, corrected by the calibrated bias of a
+    partial ensemble, is more than z standard deviations away from the image
+    threshold (params['progressive'], see calibrate_progressive).
+    z=None evaluates every student. The images are not tiled: the early
+    stop needs the max score of a whole image after each student.
+    Returns the score maps (b, h, w), the number of students evaluated per image
+    and the image scores (b, n_students) after each student, nan once stopped.'''
+    n_students = len(students)
+    b = inputs.size(0)
+    t_out = get_teacher_pred(teacher, inputs, params, engine)
+    sum_s = sum_sq = score_map = None
+    n_used = torch.full((b,), n_students, dtype=torch.long)
+    image_scores = torch.full((b, n_students), float('nan'))
+    active = torch.arange(b, device=inputs.device)
+
+    for k, student in enumerate(students, 1):
+        s = getattr(student, engine)(inputs[active]).float()
+        s_sq = torch.linalg.vector_norm(s, dim=-1)**2
+        if sum_s is None:
+            sum_s, sum_sq = s, s_sq
+        else:
+            sum_s.index_add_(0, active, s)
+            sum_sq.index_add_(0, active, s_sq)
+        del s
+
+        mu_students = sum_s[active] / k
+        s_err = torch.linalg.vector_norm(mu_students - t_out[active], dim=-1)**2
+        s_var = sum_sq[active] / k - torch.linalg.vector_norm(mu_students, dim=-1)**2
+        k_map = standardize(s_err, s_var, params)
+        if score_map is None:
+            score_map = torch.empty_like(k_map)
+        score_map[active] = k_map
+        k_scores = k_map.flatten(1).amax(dim=1)
+        image_scores[active.cpu(), k - 1] = k_scores.cpu()
+
+        if z is not None and min_students <= k < n_students:
+            progressive = params['progressive']
+            estimate = k_scores - progressive['bias'][k - 1]
+            done = (estimate - progressive['threshold']).abs() > z * progressive['std'][k - 1]
+            n_used[active[done].cpu()] = k
+            active = active[~done]
+            if active.numel() == 0:
+                break
+
+    return score_map, n_used, image_scores
+
+
+@torch.no_grad()
+def calibrate_progressive(teacher, students, params, dataloader, device, engine='fdfe'):
+    '''Image-level statistics of get_progressive_score_map on anomaly-free
+    images: the threshold is the highest image score of the full ensemble,
+    bias and std describe the gap between the image score after k students
+    and the one of the full ensemble.'''
+    print('calibrating progressive evaluation on Student dataset.')
+    scores = []
+    for _, batch in tqdm(enumerate(dataloader)):
+        inputs = batch['image'].to(device)
+        scores.append(get_progressive_score_map(inputs, teacher, students, params, engine=engine)[2])
+    scores = torch.cat(scores)
+    gap = scores - scores[:, -1:]
+    return {'threshold': scores[:, -1].max().item(),
+            'bias': gap.mean(dim=0).tolist(),
+            'std': (gap.std(dim=0) if len(gap) > 1 else torch.zeros(len(students))).tolist()}
+
+
+@torch.no_grad()
+def get_tiled_score_map(inputs, teacher, students, params, max_memory=None, engine='fdfe'):
+    '''Score map stitched from overlapping tiles, each scored within
+    a peak memory of about max_memory bytes.'''
+    score_rows = []
+    for (rows, cols), (tile_rows, tile_cols), (crop_rows, crop_cols) in \
+            image_tiles(inputs, teacher, students, max_memory):
+        tile_map = get_score_map(inputs[:, :, rows, cols], teacher, students, params, engine)
+        if tile_cols.start == 0:
+            score_rows.append([])
+        score_rows[-1].append(tile_map[:, crop_rows, crop_cols])
+    return torch.cat([torch.cat(score_row, dim=2) for score_row in score_rows], dim=1)
+
+
+@torch.no_grad()
+def get_roi_score_map(inputs, roi, teacher, students, params, max_memory=None, engine='fdfe', fill=0.):
+    '''Score map of the region of interest of a batch only, roi being a
+    (h, w) boolean mask or a list of (x0, y0, x1, y1) boxes. Only the tiles
+    covering it are scored, with their receptive field halo, so the work
+    follows the ROI area. The scores are exact inside the ROI and set to
+    fill outside of it.'''
+    b, _, imH, imW = inputs.size()
+    score_map = inputs.new_full((b, imH, imW), fill, dtype=torch.float32)
+    for (rows, cols), (tile_rows, tile_cols), (crop_rows, crop_cols) in \
+            image_tiles(inputs, teacher, students, max_memory, roi):
+        tile_map = get_score_map(inputs[:, :, rows, cols], teacher, students, params, engine)
+        score_map[:, tile_rows, tile_cols] = tile_map[:, crop_rows, crop_cols]
+    # tiles are bounding boxes, the pixels around the ROI are scored too
+    score_map[:, ~roi_mask(roi, imH, imW).to(score_map.device)] = fill
+    return score_map
+
+
+def downsample(images, size):
+    '''Image (3, h, w) or batch (b, 3, h, w) resized to (size, size)
+    with antialiasing, as scored by screen_images.'''
+    batch = images if images.dim() == 4 else images[None]
+    batch = F.interpolate(batch, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return batch if images.dim() == 4 else batch[0]
+
+
+@torch.no_grad()
+def screen_images(inputs, teacher, students, params, threshold, size=0, max_memory=None, engine='fdfe'):
+    '''Cheap pre-screen of a batch, eg: with AnomalyNet17 on downsampled images.
+    The images are scored at (size, size), or their own size when size is 0,
+    those whose max score is below threshold are considered anomaly-free.
+    Returns the max screen score of each image and the boolean mask of the
+    images to score at full resolution.'''
+    if size:
+        inputs = downsample(inputs, size)
+    score_map = get_tiled_score_map(inputs, teacher, students, params, max_memory, engine)
+    image_scores = score_map.flatten(1).amax(dim=1)
+    return image_scores, image_scores >= threshold
+
+
 def visualize(img, gt, score_map, max_score, save_path=None, show_plot=True):
     plt.figure(figsize=(13, 3))
     plt.subplot(1, 3, 1)
@@ -148,26 +335,15 @@ def detect_anomaly(args):
     device = torch.device("cuda:0" if args.gpus else "cpu")
     print(f'Device used: {device}')
 
-    # Teacher network
-    teacher = AnomalyNet.create((args.patch_size, args.patch_size))
-    teacher.eval().to(device)
-
-    # Load teacher model
-    load_model(teacher, f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt')
-
-    # Students networks
-    students = [AnomalyNet.create((args.patch_size, args.patch_size)) for _ in range(args.n_students)]
-    students = [student.eval().to(device) for student in students]
+    teacher, students = load_models(args.dataset, args.patch_size, args.n_students, device, args.fused_students)
 
-    # Loading students models
-    for i in range(args.n_students):
-        model_name = f'../model/{args.dataset}/student_{args.patch_size}_net_{i}.pt'
-        load_model(students[i], model_name)
+    # images are scored at their native size when image_size is 0
+    resize = [transforms.Resize((args.image_size, args.image_size))] if args.image_size else []
 
     # calibration on anomaly-free dataset
     calib_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
                                     transform=transforms.Compose([
-                                        transforms.Resize((args.image_size, args.image_size)),
+                                        *resize,
                                         transforms.ToTensor(),
                                         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
                                     type='train',
@@ -178,17 +354,19 @@ def detect_anomaly(args):
                                    shuffle=False, 
                                    num_workers=args.num_workers)
     
-    params = calibrate(teacher, students, calib_dataloader, device)
-
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    with autocast(device, args.precision):
+        params = calibrate(teacher, students, calib_dataloader, device, max_memory, args.engine)
+    teacher, params = deploy(teacher, params)
 
     # Load testing data
     test_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
                                   transform=transforms.Compose([
-                                    transforms.Resize((args.image_size, args.image_size)),
+                                    *resize,
                                     transforms.ToTensor(),
                                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
                                   gt_transform=transforms.Compose([
-                                    transforms.Resize((args.image_size, args.image_size)),
+                                    *resize,
                                     transforms.ToTensor()]),
                                   type='test')
 
@@ -202,29 +380,36 @@ def detect_anomaly(args):
     y_score = np.array([])
     y_true = np.array([])
     test_iter = iter(test_dataloader)
+    elapsed, n_images = 0, 0
 
     for i in range(args.test_size):
         batch = next(test_iter)
         inputs = batch['image'].to(device)
         gt = batch['gt'].cpu()
 
-        score_map = get_score_map(inputs, teacher, students, params).cpu()
+        start = time.perf_counter()
+        with autocast(device, args.precision):
+            score_map = get_tiled_score_map(inputs, teacher, students, params, max_memory, args.engine).cpu()
+        elapsed += time.perf_counter() - start
+        n_images += inputs.size(0)
         y_score = np.concatenate((y_score, rearrange(score_map, 'b h w -> (b h w)').numpy()))
         y_true = np.concatenate((y_true, rearrange(gt, 'b c h w -> (b c h w)').numpy()))
 
         if args.visualize:
             unorm = transforms.Normalize((-1, -1, -1), (2, 2, 2)) # get back to original image
-            max_score = (params['students']['err']['max'] - params['students']['err']['mu']) / torch.sqrt(params['students']['err']['var'])\
-                + (params['students']['var']['max'] - params['students']['var']['mu']) / torch.sqrt(params['students']['var']['var']).item()
+            max_score = get_max_score(params)
             img_in = rearrange(unorm(inputs).cpu(), 'b c h w -> b h w c')
             gt_in = rearrange(gt, 'b c h w -> b h w c')
 
-            for b in range(args.batch_size):
+            for b in range(inputs.size(0)):
                 visualize(img_in[b, :, :, :].squeeze(), 
                           gt_in[b, :, :, :].squeeze(), 
                           score_map[b, :, :].squeeze(), 
                           max_score)
     
+    if n_images:
+        print(f'Scored {n_images} images in {elapsed:.1f} s ({n_images / elapsed:.2f} img/s, {args.precision})')
+
     # AUC ROC
     fpr, tpr, thresholds = roc_curve(y_true.astype(int), y_score)
     plt.figure(figsize=(13, 3))
@@ -0,0 +1,91 @@
+'''
+Batched data augmentation.
+
+The DataLoader workers only decode and resize the images into uint8
+tensors (to_rgb, then transforms.PILToTensor), the random crops, flips
+and rotations of the training pipelines are then applied to the collated
+batch with vectorized operations, each image drawing its own parameters.
+The distributions are the ones of the torchvision transforms: uniform
+crops, flips with probability 0.5, nearest neighbour rotations with zero
+fill.
+'''
+
+import math
+import torch
+import torch.nn.functional as F
+
+
+def to_rgb(image):
+    '''PIL image converted to RGB (grayscale repeated, alpha dropped), a
+    module level function so that the transforms pickle to spawned workers.'''
+    return image.convert('RGB')
+
+
+def crop(images, index, top, left, size):
+    '''(size, size) crops of a batch (b, c, h, w): crop k is taken from
+    image index[k] at (top[k], left[k]), returned as (n, c, size, size).'''
+    offsets = torch.arange(size, device=images.device)
+    rows = (top[:, None] + offsets)[:, :, None]
+    cols = (left[:, None] + offsets)[:, None, :]
+    # (n, size, size, c) gathered pixels
+    crops = images.permute(0, 2, 3, 1)[index[:, None, None], rows, cols]
+    return crops.permute(0, 3, 1, 2)
+
+
+def random_crop(images, size, n_crops=1):
+    '''n_crops random (size, size) crops of each image of a batch (b, c, h, w),
+    returned as (b * n_crops, c, size, size), the crops of an image being
+    consecutive.'''
+    b, c, h, w = images.size()
+    index = torch.arange(b, device=images.device).repeat_interleave(n_crops)
+    top = torch.randint(h - size + 1, (b * n_crops,), device=images.device)
+    left = torch.randint(w - size + 1, (b * n_crops,), device=images.device)
+    return crop(images, index, top, left, size)
+
+
+def random_flip(images, dim, p=0.5):
+    '''Flip along dim (-1 horizontal, -2 vertical) each image of a batch
+    (b, c, h, w) with probability p.'''
+    flip = torch.rand((images.size(0), 1, 1, 1), device=images.device) < p
+    return torch.where(flip, images.flip(dim), images)
+
+
+def random_rotation(images, degrees):
+    '''Rotate each image of a float batch (b, c, h, w) by an angle drawn in
+    [-degrees, degrees], about its center, with nearest neighbour sampling
+    and zeros outside of the image.'''
+    b, c, h, w = images.size()
+    angle = (torch.rand(b, device=images.device) * 2 - 1) * math.radians(degrees)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    zero = torch.zeros_like(angle)
+    # normalized coordinates are scaled by the aspect ratio
+    theta = torch.stack([torch.stack([cos, -sin * h / w, zero], dim=1),
+                         torch.stack([sin * w / h, cos, zero], dim=1)], dim=1)
+    grid = F.affine_grid(theta, (b, c, h, w), align_corners=False)
+    return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+def normalize(images):
+    '''uint8 images to floats in [-1, 1], as ToTensor and Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)).'''
+    return images.float() / 127.5 - 1
+
+
+def teacher_patches(images, patch_size, n_patches=1):
+    '''uint8 training patches of teacher_training.py from a uint8 batch of
+    resized images: n_patches crops per image, flips and rotations.'''
+    patches = random_crop(images, patch_size, n_patches)
+    patches = random_flip(random_flip(patches, -1), -2)
+    # nearest neighbour sampling, the uint8 values are kept as they are
+    return random_rotation(patches.float(), 180).to(torch.uint8)
+
+
+def teacher_augmentation(images, patch_size, n_patches=1):
+    '''Training patches of teacher_training.py from a uint8 batch of resized
+    images (see teacher_patches), normalized.'''
+    return normalize(teacher_patches(images, patch_size, n_patches))
+
+
+def students_augmentation(images):
+    '''Training images of students_training.py from a uint8 batch of resized
+    images: flips.'''
+    return normalize(random_flip(random_flip(images, -1), -2))
@@ -0,0 +1,139 @@
+'''
+Benchmark of the loading of a dataset: PNG files against the images packed
+by pack_dataset (memory-mapped uint8 arrays, see AnomalyDataset).
+
+Reports the samples/s of a DataLoader over the train images with the
+transforms of students_training.py, for both backends, and checks that
+they return the same tensors. The images are packed on first use.
+With --patches_per_image, the patches/s of the teacher_training.py
+pipeline are reported too, for each number of patches drawn per decoded
+image (1 is one image decoded per patch), with the per-sample PIL
+augmentation and with the batched one of augmentation.py (--batch_augment).
+
+    python benchmark_dataset.py --dataset carpet --image_size 256
+    python benchmark_dataset.py --dataset carpet --num_workers 0 4
+    python benchmark_dataset.py --dataset carpet --patches_per_image 1 8 64
+'''
+
+import time
+from argparse import ArgumentParser
+from AnomalyDataset import AnomalyDataset
+from torchvision import transforms
+from torch.utils.data.dataloader import DataLoader
+from functools import partial
+from teacher_training import MultiPatchDataset, patch_transform
+from augmentation import to_rgb, teacher_augmentation
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset to load (in data folder)")
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--epochs', type=int, default=3, help="Number of timed passes over the dataset")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65], help="Patch size of the teacher training pipeline")
+    parser.add_argument('--patches_per_image', type=int, nargs='+', default=[], help="Numbers of teacher training patches per decoded image")
+
+    # trainer arguments
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4])
+
+    args = parser.parse_args()
+    return args
+
+
+def make_dataset(args, packed, augment=True):
+    flips = [transforms.RandomHorizontalFlip(), transforms.RandomVerticalFlip()] if augment else []
+    return AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                          transform=transforms.Compose([
+                             transforms.Resize((args.image_size, args.image_size)),
+                             *flips,
+                             transforms.ToTensor(),
+                             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
+                          gt_transform=transforms.Compose([
+                             transforms.Resize((args.image_size, args.image_size)),
+                             transforms.ToTensor()]),
+                          packed_size=args.image_size if packed else None,
+                          type='train')
+
+
+def make_patch_dataset(args, n_patches, packed, batched=False):
+    '''Teacher training patches, n_patches per decoded image, uint8 images
+    to augment by batch when batched.'''
+    resize = transforms.Resize((args.image_size, args.image_size))
+    packed_size = args.image_size if packed else None
+    if batched:
+        return AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                              transform=transforms.Compose([resize, transforms.Lambda(to_rgb), transforms.PILToTensor()]),
+                              gt_transform=None,
+                              packed_size=packed_size,
+                              type='train')
+    if n_patches == 1:
+        return AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                              transform=transforms.Compose([resize, patch_transform(args.patch_size)]),
+                              packed_size=packed_size,
+                              type='train')
+    return MultiPatchDataset(AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                                            transform=resize,
+                                            gt_transform=None,
+                                            packed_size=packed_size,
+                                            type='train'),
+                             patch_transform(args.patch_size),
+                             n_patches)
+
+
+def samples_per_second(dataset, batch_size, num_workers, epochs, n_patches=1, augment=None):
+    '''Throughput of a DataLoader, followed by augment on each batch if given.'''
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    # the first pass starts the workers and warms the page cache
+    for batch in dataloader:
+        pass
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in dataloader:
+            if augment is not None:
+                augment(batch['image'])
+    return epochs * len(dataset) * n_patches / (time.perf_counter() - start)
+
+
+def check_packed(args):
+    '''Max absolute difference between the PNG and the packed samples.'''
+    png, packed = make_dataset(args, False, False), make_dataset(args, True, False)
+    diff = 0
+    for i in range(len(png)):
+        a, b = png[i], packed[i]
+        diff = max(diff, (a['image'] - b['image']).abs().max().item(), (a['gt'] - b['gt']).abs().max().item())
+    return diff
+
+
+def benchmark(args):
+    diff = check_packed(args)
+    print(f'Max difference between PNG and packed samples: {diff:.2e}')
+
+    print(f'{"backend":<8} {"workers":>7} {"samples/s":>10}')
+    for num_workers in args.num_workers:
+        speeds = {}
+        for backend in ['png', 'packed']:
+            dataset = make_dataset(args, backend == 'packed')
+            speeds[backend] = samples_per_second(dataset, args.batch_size, num_workers, args.epochs)
+            print(f'{backend:<8} {num_workers:>7} {speeds[backend]:>10.1f}')
+        print(f'speedup x{speeds["packed"] / speeds["png"]:.1f}')
+
+    if not args.patches_per_image:
+        return
+    print(f'\nTeacher training patches ({args.patch_size}x{args.patch_size})')
+    print(f'{"backend":<8} {"augment":<7} {"workers":>7} {"patches/img":>11} {"patches/s":>10}')
+    for num_workers in args.num_workers:
+        for backend in ['png', 'packed']:
+            for batched in [False, True]:
+                for n_patches in args.patches_per_image:
+                    dataset = make_patch_dataset(args, n_patches, backend == 'packed', batched)
+                    augment = partial(teacher_augmentation, patch_size=args.patch_size, n_patches=n_patches) if batched else None
+                    speed = samples_per_second(dataset, args.batch_size, num_workers, args.epochs, n_patches, augment)
+                    print(f'{backend:<8} {"batch" if batched else "PIL":<7} {num_workers:>7} {n_patches:>11} {speed:>10.1f}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    benchmark(args)
@@ -0,0 +1,158 @@
+'''
+Benchmark of the dense feature extraction (fdfe) of the patch CNNs.
+
+Reports, for every patch size and image size, the time and the peak memory
+of one fdfe call, and checks that the optimized code path and the dilated
+(atrous) engine return the same descriptors as the original FDFE
+implementation. Batched calls are checked
+against the per-image result and their throughput is reported. With
+--n_students, the students run one after another are compared with the
+same students packed in an EnsembleAnomalyNet.
+
+    python benchmark_fdfe.py --patch_sizes 17 33 65 --image_sizes 256 512
+    python benchmark_fdfe.py --image_sizes 256 --batch_sizes 1 4 8 16
+    python benchmark_fdfe.py --image_sizes 256 --n_students 3
+'''
+
+import time
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from AnomalyNet import AnomalyNet, EnsembleAnomalyNet
+from FDFE import multiMaxPooling, unwrapPrepare, unwrapPool
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--patch_sizes', type=int, nargs='+', default=[17, 33, 65], choices=[17, 33, 65])
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1], help="Number of images per fdfe call")
+    parser.add_argument('--n_students', type=int, default=0, help="Number of students in the ensemble benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of timed calls per configuration")
+
+    # trainer arguments
+    parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
+
+    args = parser.parse_args()
+    return args
+
+
+def original_fdfe(net, x):
+    '''Reference: the original FDFE path (per-shift pooling, unwrapPool chain),
+    applied with the weights of net.'''
+    imH, imW = x.size(2), x.size(3)
+    convs = [net.conv1, net.conv2, net.conv3, net.conv4] + ([net.conv5] if hasattr(net, 'conv5') else [])
+    n_pools = {17: 0, 33: 2, 65: 3}[net.size]
+    pooling = multiMaxPooling(2, 2, 2, 2)
+
+    x = net.multiPoolPrepare(x)
+    for i, conv in enumerate(convs):
+        x = net.l_relu(conv(x))
+        if i < n_pools:
+            x = pooling(x)
+
+    if n_pools:
+        x = unwrapPrepare()(x)
+        for k in reversed(range(1, n_pools + 1)):
+            x = unwrapPool(net.outChans, imH / 2**k, imW / 2**k, 2, 2)(x)
+    y = x.view(net.outChans, imH, imW, -1)
+    y = y.permute(3, 1, 2, 0)
+    return net.l_relu(net.decode(y))
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def timeit(fn, inputs, device, repeat):
+    '''Median wall-clock time (s) of fn(inputs), after one warm-up call.'''
+    fn(inputs)
+    times = []
+    for _ in range(repeat):
+        synchronize(device)
+        start = time.perf_counter()
+        fn(inputs)
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+@torch.no_grad()
+def peak_memory(fn, inputs, device):
+    '''Peak memory (bytes) allocated by torch during fn(inputs), inputs excluded.'''
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn(inputs)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn(inputs)
+    # allocations are reported on the ops (self usage), frees as '[memory]' events
+    events = sorted((e.time_range.start, e.cpu_memory_usage if e.name == '[memory]' else e.self_cpu_memory_usage)
+                    for e in prof.events())
+    current, peak = 0, 0
+    for _, usage in events:
+        current += usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark(name, fn, inputs, device, repeat):
+    t = timeit(fn, inputs, device, repeat)
+    mem = peak_memory(fn, inputs, device)
+    print(f'{name:<28} {t * 1000:10.1f} ms {mem / 2**20:10.1f} MiB {inputs.size(0) / t:8.2f} img/s')
+    return t, mem
+
+
+def main(args):
+    device = torch.device("cuda:0" if args.gpus else "cpu")
+    print(f'Device used: {device}')
+
+    for patch_size in args.patch_sizes:
+        net = AnomalyNet.create((patch_size, patch_size))
+        net.eval().to(device)
+
+        for image_size in args.image_sizes:
+            inputs = torch.randn(1, 3, image_size, image_size, device=device)
+            print(f'\nAnomalyNet{patch_size} - fdfe on {image_size}x{image_size}')
+
+            with torch.no_grad():
+                reference = original_fdfe(net, inputs)
+                assert torch.equal(net.fdfe(inputs), reference), 'fdfe output differs from the original FDFE'
+            benchmark('original FDFE', lambda x: original_fdfe(net, x), inputs, device, args.repeat)
+            benchmark('fdfe', net.fdfe, inputs, device, args.repeat)
+            with torch.no_grad():
+                assert torch.allclose(net.atrous(inputs), reference, atol=1e-5), 'atrous output differs from FDFE'
+            benchmark('atrous', net.atrous, inputs, device, args.repeat)
+
+            for batch_size in args.batch_sizes:
+                if batch_size == 1:
+                    continue
+                batch = torch.randn(batch_size, 3, image_size, image_size, device=device)
+                with torch.no_grad():
+                    per_image = torch.cat([net.fdfe(batch[i:i + 1]) for i in range(batch_size)])
+                    assert torch.allclose(net.fdfe(batch), per_image, atol=1e-5), \
+                        f'fdfe on a batch of {batch_size} differs from the per-image result'
+                benchmark(f'fdfe (batch of {batch_size})', net.fdfe, batch, device, args.repeat)
+
+            if args.n_students:
+                students = [AnomalyNet.create((patch_size, patch_size)).eval().to(device)
+                            for _ in range(args.n_students)]
+                ensemble = EnsembleAnomalyNet.from_nets(students).eval().to(device)
+                sequential = lambda x: torch.stack([student.fdfe(x) for student in students], dim=1)
+                with torch.no_grad():
+                    assert torch.allclose(ensemble.fdfe(inputs), sequential(inputs), atol=1e-5), \
+                        'EnsembleAnomalyNet output differs from the sequential students'
+                benchmark(f'{args.n_students} students', sequential, inputs, device, args.repeat)
+                benchmark(f'{args.n_students} students (fused)', ensemble.fdfe, inputs, device, args.repeat)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,112 @@
+'''
+Benchmark of student training: the students trained one after another
+(students_training.py) against all of them trained in the same pass over
+the data (--concurrent), with their own batches or shared ones, and with
+the students updated in parallel threads.
+
+Random images and randomly initialized networks are used, the data loading
+saved by the concurrent training is not included. Reports the wall-clock
+time of n_steps steps of every student and the speedup over the sequential
+training, for every number of students.
+
+    python benchmark_students.py --patch_size 33 --n_students 3 10
+    python benchmark_students.py --image_size 128 --student_workers 1 4
+'''
+
+import time
+import torch
+import torch.optim as optim
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from AnomalyNet import AnomalyNet
+from students_training import train_step
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--patch_size', type=int, default=33, choices=[17, 33, 65])
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--n_students', type=int, nargs='+', default=[3, 10], help="Numbers of students to train")
+    parser.add_argument('--student_workers', type=int, nargs='+', default=[1], help="Numbers of threads of the concurrent training")
+    parser.add_argument('--n_steps', type=int, default=5, help="Number of timed steps per student")
+
+    # trainer arguments
+    parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+
+    args = parser.parse_args()
+    return args
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def sequential(teacher, students, optimizers, batches):
+    '''Each student in turn, the teacher runs on each of its batches.'''
+    for student, optimizer in zip(students, optimizers):
+        for inputs in batches:
+            with torch.no_grad():
+                targets = teacher.fdfe(inputs)
+            train_step(student, optimizer, inputs, targets)
+
+
+def concurrent(teacher, students, optimizers, batches, shared, executor=None):
+    '''Every student at each step, the teacher runs once per step on the
+    batches of all the students, or on their shared batch.'''
+    n_students = len(students)
+    for inputs in batches:
+        if not shared:
+            inputs = inputs.repeat(n_students, 1, 1, 1)
+        with torch.no_grad():
+            targets = teacher.fdfe(inputs)
+        if shared:
+            inputs, targets = [inputs] * n_students, [targets] * n_students
+        else:
+            inputs, targets = inputs.chunk(n_students), targets.chunk(n_students)
+        list((executor.map if executor else map)(train_step, students, optimizers, inputs, targets))
+
+
+def timed(f, device, *args):
+    synchronize(device)
+    start = time.perf_counter()
+    f(*args)
+    synchronize(device)
+    return time.perf_counter() - start
+
+
+def benchmark(args):
+    device = torch.device("cuda:0" if args.gpus else "cpu")
+    print(f'Device used: {device}')
+    size = (args.patch_size, args.patch_size)
+    teacher = AnomalyNet.create(size).eval().to(device)
+    batches = [torch.rand((args.batch_size, 3, args.image_size, args.image_size), device=device) * 2 - 1
+               for _ in range(args.n_steps)]
+
+    print(f'AnomalyNet{args.patch_size}, {args.image_size}x{args.image_size} images, '
+          f'batch size {args.batch_size}, {args.n_steps} steps per student')
+    print(f'{"students":>8} {"mode":<26} {"time (s)":>9} {"speedup":>8}')
+    for n_students in args.n_students:
+        students = [AnomalyNet.create(size).to(device) for _ in range(n_students)]
+        optimizers = [optim.Adam(student.parameters(), lr=args.learning_rate) for student in students]
+
+        # warm-up
+        concurrent(teacher, students, optimizers, batches[:1], True)
+
+        reference = timed(sequential, device, teacher, students, optimizers, batches)
+        print(f'{n_students:>8} {"sequential":<26} {reference:>9.2f} {1:>8.2f}')
+        for workers in args.student_workers:
+            executor = ThreadPoolExecutor(workers) if workers > 1 else None
+            for shared in [False, True]:
+                elapsed = timed(concurrent, device, teacher, students, optimizers, batches, shared, executor)
+                mode = f'concurrent{", shared" if shared else ""}, {workers} thr'
+                print(f'{n_students:>8} {mode:<26} {elapsed:>9.2f} {reference / elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    benchmark(args)
@@ -0,0 +1,92 @@
+'''
+Offline ResNet18 target bank for the teacher training of a dataset.
+
+A fixed pool of n_patches augmented training patches (the augmentation of
+teacher_training.py: random crop, flips and rotation) is drawn once, with
+the ResNet18 descriptor of each patch. They are saved as memory-mapped
+arrays in ../model/{dataset}/target_bank_{patch_size}_{image_size}/: uint8
+patches (N, 3, p, p) in patches.npy and float16 targets (N, 512) in
+targets.npy, with the settings of the bank and a fingerprint of the
+ResNet18 weights in bank.json.
+teacher_training.py --max_steps ... --target_bank then trains on them,
+without running ResNet18, once they match its own settings.
+
+    python build_target_bank.py --dataset carpet --patch_size 65 --n_patches 100000
+'''
+
+import os
+import json
+import shutil
+import torch
+import numpy as np
+from tqdm import tqdm
+from argparse import ArgumentParser
+from augmentation import normalize, teacher_patches
+from teacher_training import load_image_bank, load_resnet18, resnet18_fingerprint, patch_targets, target_bank_dir
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset to sample the patches from (in data folder)")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65], help="Height and width of patch CNN")
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--packed', action='store_true', help="Read the images packed at image_size (see pack_dataset) instead of the PNG files")
+    parser.add_argument('--n_patches', type=int, default=50000, help="Number of patches of the bank")
+
+    # trainer arguments
+    parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=4)
+
+    args = parser.parse_args()
+    return args
+
+
+@torch.no_grad()
+def build_target_bank(args):
+    # Choosing device
+    device = torch.device("cuda:0" if args.gpus else "cpu")
+    print(f'Device used: {device}')
+
+    resnet18 = load_resnet18(args.dataset, device)
+    bank = load_image_bank(args)
+    print(f"Number of training samples: {len(bank)}")
+
+    path = target_bank_dir(args.dataset, args.patch_size, args.image_size)
+    # written in another folder, an interrupted run leaves no partial bank
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    p = args.patch_size
+    patches = np.lib.format.open_memmap(os.path.join(tmp_path, 'patches.npy'), mode='w+', dtype=np.uint8,
+                                        shape=(args.n_patches, 3, p, p))
+    targets = None
+
+    for start in tqdm(range(0, args.n_patches, args.batch_size)):
+        n = min(args.batch_size, args.n_patches - start)
+        batch = teacher_patches(bank[torch.randint(len(bank), (n,))], p)
+        batch_targets = patch_targets(resnet18, normalize(batch).to(device))
+        if targets is None:
+            targets = np.lib.format.open_memmap(os.path.join(tmp_path, 'targets.npy'), mode='w+', dtype=np.float16,
+                                                shape=(args.n_patches, batch_targets.size(1)))
+        patches[start:start + n] = batch.numpy()
+        targets[start:start + n] = batch_targets.half().cpu().numpy()
+
+    patches.flush()
+    targets.flush()
+    del patches, targets
+    metadata = {'dataset': args.dataset, 'patch_size': p, 'image_size': args.image_size,
+                'packed': args.packed, 'n_patches': args.n_patches,
+                'resnet18': resnet18_fingerprint(args.dataset)}
+    with open(os.path.join(tmp_path, 'bank.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print(f'Target bank of {args.n_patches} patches saved to {path}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    build_target_bank(args)
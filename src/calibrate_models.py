@@ -4,12 +4,11 @@ from tqdm import tqdm
 from argparse import ArgumentParser
 import pickle
 import os
-from AnomalyNet import AnomalyNet
 from AnomalyDataset import AnomalyDataset
 from torchvision import transforms
 from torch.utils.data.dataloader import DataLoader
-from utils import load_model
-from anomaly_detection import calibrate
+from utils import load_models, autocast
+from anomaly_detection import calibrate, calibrate_progressive
 
 def parse_arguments():
     parser = ArgumentParser()
@@ -18,7 +17,13 @@ def parse_arguments():
     parser.add_argument('--dataset', type=str, default='carpet', help="Dataset to calibrate on")
     parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
     parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
-    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--image_size', type=int, default=256, help="Size images are resized to, 0 keeps their native size")
+    parser.add_argument('--fused_students', action='store_true', help="Run the students as one grouped network")
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--engine', type=str, default='fdfe', choices=['fdfe', 'atrous'], help="Dense evaluation of the patch CNNs")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help="Run the networks in bfloat16 with autocast, scores and statistics stay in fp32")
+    parser.add_argument('--progressive', action='store_true', help="Also calibrate the early stopping of predict_anomaly.py --progressive")
+    parser.add_argument('--quantized', action='store_true', help="Calibrate the INT8 models of quantize_models.py (CPU)")
 
     # trainer arguments
     parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
@@ -29,30 +34,24 @@ def parse_arguments():
     return args
 
 def calibrate_models(args):
+    if args.progressive and args.fused_students:
+        raise ValueError('The progressive evaluation runs the students one at a time, without --fused_students.')
+    if args.progressive and args.max_memory:
+        raise ValueError('The progressive evaluation scores whole images, it is not tiled to --max_memory.')
+
     # Choosing device 
-    device = torch.device("cuda:0" if args.gpus else "cpu")
+    device = torch.device("cuda:0" if args.gpus and not args.quantized else "cpu")
     print(f'Device used: {device}')
 
-    # Teacher network
-    teacher = AnomalyNet.create((args.patch_size, args.patch_size))
-    teacher.eval().to(device)
-
-    # Load teacher model
-    load_model(teacher, f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt')
-
-    # Students networks
-    students = [AnomalyNet.create((args.patch_size, args.patch_size)) for _ in range(args.n_students)]
-    students = [student.eval().to(device) for student in students]
+    teacher, students = load_models(args.dataset, args.patch_size, args.n_students, device, args.fused_students, args.quantized)
 
-    # Loading students models
-    for i in range(args.n_students):
-        model_name = f'../model/{args.dataset}/student_{args.patch_size}_net_{i}.pt'
-        load_model(students[i], model_name)
+    # images are scored at their native size when image_size is 0
+    resize = [transforms.Resize((args.image_size, args.image_size))] if args.image_size else []
 
     # calibration on anomaly-free dataset
     calib_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
                                     transform=transforms.Compose([
-                                        transforms.Resize((args.image_size, args.image_size)),
+                                        *resize,
                                         transforms.ToTensor(),
                                         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
                                     type='train',
@@ -64,11 +63,16 @@ def calibrate_models(args):
                                    num_workers=args.num_workers)
     
     print("Starting calibration process...")
-    params = calibrate(teacher, students, calib_dataloader, device)
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    with autocast(device, args.precision):
+        params = calibrate(teacher, students, calib_dataloader, device, max_memory, args.engine)
+        if args.progressive:
+            params['progressive'] = calibrate_progressive(teacher, students, params, calib_dataloader, device, args.engine)
     
     # Save calibration parameters
     os.makedirs(f'../model/{args.dataset}', exist_ok=True)
-    calibration_file = f'../model/{args.dataset}/calibration_{args.patch_size}.pkl'
+    suffix = '_int8' if args.quantized else ''
+    calibration_file = f'../model/{args.dataset}/calibration_{args.patch_size}{suffix}.pkl'
     with open(calibration_file, 'wb') as f:
         pickle.dump(params, f)
     
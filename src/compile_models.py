@@ -0,0 +1,125 @@
+'''
+Compile the teacher, the students and the scoring of a dataset into a
+TorchScript module, traced for one patch size and input shape, and saved
+next to the weights: ../model/{dataset}/scorer_{patch_size}_{image_size}_{fingerprint}.ts
+
+The file name holds a fingerprint of the weights, of the calibration and of
+the configuration it was traced with (batch size, engine, ...), scorers
+traced with other settings are kept side by side and reused as long as
+their inputs are unchanged.
+
+    python compile_models.py --dataset carpet --patch_size 33 --n_students 3
+'''
+
+import torch
+import hashlib
+import pickle
+import os
+from argparse import ArgumentParser
+from AnomalyScorer import AnomalyScorer, trace_scorer
+from utils import load_models
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset the models were trained on")
+    parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--engine', type=str, default='fdfe', choices=['fdfe', 'atrous'], help="Dense evaluation of the patch CNNs")
+    parser.add_argument('--calibration_file', type=str, default=None, help="Path to saved calibration parameters")
+
+    # trainer arguments
+    parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
+    parser.add_argument('--batch_size', type=int, default=1)
+
+    args = parser.parse_args()
+    return args
+
+
+def scorer_path(args, calibration_file):
+    '''Path of the scorer, named after its fingerprint.'''
+    return f'../model/{args.dataset}/scorer_{args.patch_size}_{args.image_size}_{fingerprint(args, calibration_file)[:16]}.ts'
+
+
+def fingerprint(args, calibration_file):
+    '''Hash of everything the compiled scorer depends on.'''
+    sha = hashlib.sha256()
+    config = (args.patch_size, args.image_size, args.batch_size, args.n_students,
+              args.max_memory, args.engine, torch.__version__)
+    sha.update(repr(config).encode())
+    model_files = [f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt'] + \
+                  [f'../model/{args.dataset}/student_{args.patch_size}_net_{i}.pt' for i in range(args.n_students)] + \
+                  [calibration_file]
+    for model_file in model_files:
+        if os.path.exists(model_file):
+            with open(model_file, 'rb') as f:
+                sha.update(f.read())
+        else:
+            sha.update(f'missing {model_file}'.encode())
+    return sha.hexdigest()
+
+
+def load_compiled_scorer(args, calibration_file, device):
+    '''Saved scorer if it is up to date, None otherwise.'''
+    path = scorer_path(args, calibration_file)
+    if not os.path.exists(path):
+        return None
+    extra_files = {'fingerprint': ''}
+    scorer = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    if extra_files['fingerprint'].decode() != fingerprint(args, calibration_file):
+        print(f'Compiled scorer {path} is out of date.')
+        return None
+    print(f'Loading of compiled scorer {path} succesful.')
+    return scorer
+
+
+def compile_scorer(args, teacher, students, params, calibration_file, device):
+    '''Trace the scorer for (batch_size, 3, image_size, image_size) inputs and save it.'''
+    if not args.image_size:
+        raise ValueError('Compiled scorers are traced for one input shape, an image_size is required.')
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    scorer = AnomalyScorer(teacher, students, params, max_memory, args.engine).to(device)
+    example = torch.zeros((args.batch_size, 3, args.image_size, args.image_size), device=device)
+    scorer = trace_scorer(scorer, example)
+
+    path = scorer_path(args, calibration_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.jit.save(scorer, path, _extra_files={'fingerprint': fingerprint(args, calibration_file)})
+    print(f'Compiled scorer saved to {path}.')
+    return scorer
+
+
+def compiled_score_map(scorer, inputs, batch_size):
+    '''Score map of a batch with a scorer traced for batch_size images,
+    the last (smaller) batch of a dataset is padded with zeros.'''
+    n = inputs.size(0)
+    if n < batch_size:
+        inputs = torch.cat([inputs, inputs.new_zeros((batch_size - n,) + inputs.shape[1:])])
+    with torch.no_grad():
+        return scorer(inputs)[:n]
+
+
+def compile_models(args):
+    # Choosing device
+    device = torch.device("cuda:0" if args.gpus else "cpu")
+    print(f'Device used: {device}')
+
+    calibration_file = args.calibration_file or f'../model/{args.dataset}/calibration_{args.patch_size}.pkl'
+    if load_compiled_scorer(args, calibration_file, device) is not None:
+        print('Compiled scorer is up to date.')
+        return
+
+    with open(calibration_file, 'rb') as f:
+        params = pickle.load(f)
+
+    teacher, students = load_models(args.dataset, args.patch_size, args.n_students, device)
+    compile_scorer(args, teacher, students, params, calibration_file, device)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    compile_models(args)
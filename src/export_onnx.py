@@ -0,0 +1,104 @@
+'''
+Export the teacher, the students and the scoring of a dataset to a single
+ONNX graph, for one patch size and input shape, saved next to the weights:
+../model/{dataset}/scorer_{patch_size}_{image_size}.onnx
+
+The exported graph is run once with onnxruntime on random images and its
+score map is checked against the PyTorch one (get_tiled_score_map).
+The settings it was exported with are saved next to it (.json), with a
+fingerprint of the weights and of the calibration, for predict_onnx.py
+which runs it on CPU without PyTorch.
+
+    python export_onnx.py --dataset carpet --patch_size 33 --n_students 3
+'''
+
+import torch
+import numpy as np
+import pickle
+import os
+import json
+from argparse import ArgumentParser
+from AnomalyScorer import AnomalyScorer
+from anomaly_detection import get_tiled_score_map, get_max_score
+from utils import load_models, params_to
+from predict_onnx import onnx_path, load_onnx_scorer, onnx_score_map, metadata_path, weights_fingerprint
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset the models were trained on")
+    parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--engine', type=str, default='atrous', choices=['fdfe', 'atrous'], help="Dense evaluation of the patch CNNs, atrous gives a smaller graph")
+    parser.add_argument('--calibration_file', type=str, default=None, help="Path to saved calibration parameters")
+    parser.add_argument('--opset', type=int, default=17, help="ONNX opset version")
+    parser.add_argument('--rtol', type=float, default=1e-4, help="Tolerance of the parity check, relative to the largest score")
+
+    # trainer arguments
+    parser.add_argument('--batch_size', type=int, default=1)
+
+    args = parser.parse_args()
+    return args
+
+
+def save_metadata(args, params, calibration_file, path):
+    '''Settings of the exported scorer, read by predict_onnx.py.'''
+    metadata = {'patch_size': args.patch_size, 'image_size': args.image_size, 'batch_size': args.batch_size,
+                'n_students': args.n_students, 'engine': args.engine, 'max_memory': args.max_memory,
+                'max_score': get_max_score(params), 'calibration_file': calibration_file,
+                'fingerprint': weights_fingerprint(args.dataset, args.patch_size, args.n_students, calibration_file)}
+    with open(metadata_path(path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+@torch.no_grad()
+def export_scorer(args, teacher, students, params, path):
+    '''Export the scorer for (batch_size, 3, image_size, image_size) inputs.'''
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    scorer = AnomalyScorer(teacher, students, params, max_memory, args.engine).eval()
+    example = torch.zeros((args.batch_size, 3, args.image_size, args.image_size))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(scorer, (example,), path,
+                      input_names=['image'], output_names=['score_map'],
+                      opset_version=args.opset, dynamo=False)
+    print(f'ONNX scorer saved to {path}.')
+
+
+@torch.no_grad()
+def check_parity(session, teacher, students, params, args):
+    '''Max absolute difference between the onnxruntime and the PyTorch score
+    maps, relative to the largest PyTorch score.'''
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    inputs = torch.rand((args.batch_size, 3, args.image_size, args.image_size)) * 2 - 1
+    expected = get_tiled_score_map(inputs, teacher, students, params, max_memory, args.engine).numpy()
+    score_map = onnx_score_map(session, inputs.numpy())
+    return float(np.abs(score_map - expected).max() / np.abs(expected).max())
+
+
+def export_onnx(args):
+    calibration_file = args.calibration_file or f'../model/{args.dataset}/calibration_{args.patch_size}.pkl'
+    with open(calibration_file, 'rb') as f:
+        params = pickle.load(f)
+    # the graph runs on CPU
+    params = params_to(params, torch.device('cpu'))
+
+    teacher, students = load_models(args.dataset, args.patch_size, args.n_students, torch.device('cpu'))
+    path = onnx_path(args)
+    export_scorer(args, teacher, students, params, path)
+    save_metadata(args, params, calibration_file, path)
+
+    session = load_onnx_scorer(path)
+    diff = check_parity(session, teacher, students, params, args)
+    print(f'Max difference with the PyTorch score map (relative): {diff:.2e}')
+    if diff > args.rtol:
+        raise RuntimeError(f'ONNX score map differs from the PyTorch one ({diff:.2e} > {args.rtol:.0e}).')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    export_onnx(args)
@@ -1,17 +1,22 @@
+import time
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from argparse import ArgumentParser
 from einops import rearrange
-from AnomalyNet import AnomalyNet
 from AnomalyDataset import AnomalyDataset
 from torchvision import transforms
 from torch.utils.data.dataloader import DataLoader
-from utils import load_model
+from utils import load_models, autocast
 import pickle
 import os
-from anomaly_detection import get_score_map, visualize
+from functools import partial
+from PIL import Image
+from anomaly_detection import calibrate, get_tiled_score_map, get_roi_score_map, get_progressive_score_map, get_max_score, get_min_score, deploy, downsample, screen_images, visualize
+from AnomalyScorer import MultiScaleScorer
+from compile_models import load_compiled_scorer, compile_scorer, compiled_score_map
+from tiling import roi_mask
 
 def parse_arguments():
     parser = ArgumentParser()
@@ -21,9 +26,26 @@ def parse_arguments():
     parser.add_argument('--test_size', type=int, default=89, help="Number of batch for the test set")
     parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
     parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
-    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--multiscale', action='store_true', help="Average the scores of every calibrated patch size (17, 33, 65)")
+    parser.add_argument('--scale_workers', type=int, default=1, help="Number of patch sizes scored concurrently with --multiscale")
+    parser.add_argument('--image_size', type=int, default=256, help="Size images are resized to, 0 keeps their native size")
+    parser.add_argument('--cascade', action='store_true', help="Pre-screen images, only the suspicious ones get the full scoring")
+    parser.add_argument('--screen_patch_size', type=int, default=17, choices=[17, 33, 65], help="Patch size of the pre-screen networks")
+    parser.add_argument('--screen_size', type=int, default=128, help="Size images are downsampled to for the pre-screen, 0 keeps image_size")
+    parser.add_argument('--screen_margin', type=float, default=0.8, help="Full scoring above this fraction of the max screen score of anomaly-free images")
+    parser.add_argument('--roi', type=str, default=None, help="Mask image of the region of interest (non-zero pixels), only it is scored")
+    parser.add_argument('--roi_boxes', type=int, nargs='+', default=None, help="Region of interest as x0 y0 x1 y1 boxes (image_size pixels), only they are scored")
+    parser.add_argument('--fused_students', action='store_true', help="Run the students as one grouped network")
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--engine', type=str, default='fdfe', choices=['fdfe', 'atrous'], help="Dense evaluation of the patch CNNs")
     parser.add_argument('--visualize', type=bool, default=True, help="Display anomaly map batch per batch")
     parser.add_argument('--calibration_file', type=str, default=None, help="Path to saved calibration parameters")
+    parser.add_argument('--compile', action='store_true', help="Use (and build if needed) the TorchScript scorer of compile_models.py")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help="Run the networks in bfloat16 with autocast, scores and statistics stay in fp32")
+    parser.add_argument('--progressive', action='store_true', help="Evaluate the students one at a time and stop early when the image score is clear")
+    parser.add_argument('--progressive_z', type=float, default=3.0, help="Early stopping confidence, in calibrated standard deviations")
+    parser.add_argument('--min_students', type=int, default=2, help="Number of students evaluated before early stopping")
+    parser.add_argument('--quantized', action='store_true', help="Run the INT8 models of quantize_models.py (CPU)")
 
     # trainer arguments
     parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
@@ -33,45 +55,170 @@ def parse_arguments():
     args = parser.parse_args()
     return args
 
-def predict_anomaly(args):
-    # Choosing device 
-    device = torch.device("cuda:0" if args.gpus else "cpu")
-    print(f'Device used: {device}')
-
-    # Teacher network
-    teacher = AnomalyNet.create((args.patch_size, args.patch_size))
-    teacher.eval().to(device)
-
-    # Load teacher model
-    load_model(teacher, f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt')
-
-    # Students networks
-    students = [AnomalyNet.create((args.patch_size, args.patch_size)) for _ in range(args.n_students)]
-    students = [student.eval().to(device) for student in students]
+def load_multiscale_scorer(args, device):
+    '''MultiScaleScorer of every patch size calibrated on the dataset,
+    and the means of their max and min scores.'''
+    suffix = '_int8' if args.quantized else ''
+    models, max_scores, min_scores = {}, [], []
+    for patch_size in [17, 33, 65]:
+        calibration_file = f'../model/{args.dataset}/calibration_{patch_size}{suffix}.pkl'
+        if not os.path.exists(calibration_file):
+            continue
+        print(f"Loading calibration parameters from {calibration_file}")
+        with open(calibration_file, 'rb') as f:
+            params = pickle.load(f)
+        teacher, students = load_models(args.dataset, patch_size, args.n_students, device,
+                                        args.fused_students, args.quantized)
+        teacher, params = deploy(teacher, params)
+        models[patch_size] = (teacher, students, params)
+        max_scores.append(get_max_score(params))
+        min_scores.append(get_min_score(params))
 
-    # Loading students models
-    for i in range(args.n_students):
-        model_name = f'../model/{args.dataset}/student_{args.patch_size}_net_{i}.pt'
-        load_model(students[i], model_name)
+    if not models:
+        return None, None, None
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    scorer = MultiScaleScorer(models, max_memory, args.engine, args.precision, args.scale_workers)
+    return scorer, sum(max_scores) / len(max_scores), sum(min_scores) / len(min_scores)
 
-    # Load calibration parameters from file
-    calibration_file = args.calibration_file or f'../model/{args.dataset}/calibration_{args.patch_size}.pkl'
+def load_screen(args, device):
+    '''Deployed pre-screen networks and parameters of --cascade, and the
+    score threshold: screen_margin times the highest image max score of the
+    anomaly-free train images at the screen size. They are calibrated on
+    first use.'''
+    teacher, students = load_models(args.dataset, args.screen_patch_size, args.n_students, device,
+                                    args.fused_students, args.quantized)
+    suffix = '_int8' if args.quantized else ''
+    calibration_file = f'../model/{args.dataset}/calibration_{args.screen_patch_size}_screen_{args.screen_size}_{args.image_size}{suffix}.pkl'
     if os.path.exists(calibration_file):
-        print(f"Loading calibration parameters from {calibration_file}")
+        print(f"Loading pre-screen calibration parameters from {calibration_file}")
         with open(calibration_file, 'rb') as f:
             params = pickle.load(f)
+        teacher, params = deploy(teacher, params)
     else:
-        print(f"Calibration file {calibration_file} not found. Please run calibration first.")
+        # same downsampling as the test images
+        resize = [transforms.Resize((args.image_size, args.image_size))] if args.image_size else []
+        screen_resize = [transforms.Lambda(partial(downsample, size=args.screen_size))] if args.screen_size else []
+        calib_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                                       transform=transforms.Compose([
+                                            *resize,
+                                            transforms.ToTensor(),
+                                            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+                                            *screen_resize]),
+                                       type='train',
+                                       label=0)
+        calib_dataloader = DataLoader(calib_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+        with autocast(device, args.precision):
+            params = calibrate(teacher, students, calib_dataloader, device, engine=args.engine)
+            teacher, params = deploy(teacher, params)
+            image_max = max(get_tiled_score_map(batch['image'].to(device), teacher, students, params, engine=args.engine).amax().item()
+                            for batch in calib_dataloader)
+        params['screen'] = {'max': image_max}
+        with open(calibration_file, 'wb') as f:
+            pickle.dump(params, f)
+        print(f"Pre-screen calibration parameters saved to {calibration_file}")
+
+    threshold = args.screen_margin * params['screen']['max']
+    return teacher, students, params, threshold
+
+def load_roi(args):
+    '''Region of interest of --roi (boolean mask resized to image_size) or
+    of --roi_boxes (list of boxes), None when none is given.'''
+    if args.roi_boxes is not None:
+        if len(args.roi_boxes) % 4:
+            raise ValueError('--roi_boxes expects groups of 4 coordinates: x0 y0 x1 y1.')
+        return [tuple(args.roi_boxes[i:i + 4]) for i in range(0, len(args.roi_boxes), 4)]
+    if args.roi is not None:
+        mask = Image.open(args.roi).convert('L')
+        if args.image_size:
+            mask = mask.resize((args.image_size, args.image_size), Image.NEAREST)
+        return torch.from_numpy(np.array(mask) > 0)
+    return None
+
+def predict_anomaly(args):
+    if args.quantized and args.compile:
+        raise ValueError('The INT8 models do not run with --compile.')
+    if args.multiscale and args.compile:
+        raise ValueError('Multi-scale scoring does not run with --compile.')
+    if args.progressive and (args.multiscale or args.compile or args.fused_students):
+        raise ValueError('The progressive evaluation runs the students one at a time, without --compile or --multiscale.')
+    if args.progressive and args.max_memory:
+        raise ValueError('The progressive evaluation scores whole images, it is not tiled to --max_memory.')
+    roi = load_roi(args)
+    if roi is not None and (args.multiscale or args.progressive or args.compile):
+        raise ValueError('Region of interest scoring does not run with --compile, --multiscale or --progressive.')
+
+    # Choosing device, INT8 kernels are CPU only
+    device = torch.device("cuda:0" if args.gpus and not args.quantized else "cpu")
+    print(f'Device used: {device}')
+
+    # Scorer of every calibrated patch size, sharing the input batches
+    scorer = None
+    multiscale, max_score, min_score = load_multiscale_scorer(args, device) if args.multiscale else (None, None, None)
+    if args.multiscale and multiscale is None:
+        print(f"No calibration file found in ../model/{args.dataset}. Please run calibration first.")
         return
 
+    if multiscale is None:
+        # Load calibration parameters from file
+        suffix = '_int8' if args.quantized else ''
+        calibration_file = args.calibration_file or f'../model/{args.dataset}/calibration_{args.patch_size}{suffix}.pkl'
+        if os.path.exists(calibration_file):
+            print(f"Loading calibration parameters from {calibration_file}")
+            with open(calibration_file, 'rb') as f:
+                params = pickle.load(f)
+        else:
+            print(f"Calibration file {calibration_file} not found. Please run calibration first.")
+            return
+        if args.progressive and 'progressive' not in params:
+            print(f"Calibration file {calibration_file} has no progressive parameters. Please run calibration with --progressive.")
+            return
+        max_score = get_max_score(params)
+        min_score = get_min_score(params)
+
+        # Compiled scorer, rebuilt when the models changed
+        scorer = load_compiled_scorer(args, calibration_file, device) if args.compile else None
+
+        if scorer is None:
+            teacher, students = load_models(args.dataset, args.patch_size, args.n_students, device,
+                                            args.fused_students, args.quantized)
+            if args.compile:
+                scorer = compile_scorer(args, teacher, students, params, calibration_file, device)
+            else:
+                teacher, params = deploy(teacher, params)
+
+    # Pre-screen of --cascade
+    screen = load_screen(args, device) if args.cascade else None
+
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    students_used = []
+
+    def score(inputs):
+        if args.progressive:
+            with autocast(device, args.precision):
+                score_map, n_used, _ = get_progressive_score_map(inputs, teacher, students, params, args.progressive_z,
+                                                                  args.min_students, args.engine)
+            students_used.append(n_used)
+            return score_map.cpu()
+        if multiscale is not None:
+            return multiscale(inputs)[0].cpu()
+        if scorer is not None:
+            return compiled_score_map(scorer, inputs, args.batch_size).cpu()
+        with autocast(device, args.precision):
+            if roi is not None:
+                return get_roi_score_map(inputs, roi, teacher, students, params, max_memory, args.engine).cpu()
+            return get_tiled_score_map(inputs, teacher, students, params, max_memory, args.engine).cpu()
+
+    # images are scored at their native size when image_size is 0
+    resize = [transforms.Resize((args.image_size, args.image_size))] if args.image_size else []
+
     # Load testing data
     test_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
                                   transform=transforms.Compose([
-                                    transforms.Resize((args.image_size, args.image_size)),
+                                    *resize,
                                     transforms.ToTensor(),
                                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
                                   gt_transform=transforms.Compose([
-                                    transforms.Resize((args.image_size, args.image_size)),
+                                    *resize,
                                     transforms.ToTensor()]),
                                   type='test')
 
@@ -93,41 +240,87 @@ def predict_anomaly(args):
 
     # Determine the number of batches to process
     num_batches_to_process = min(args.test_size, len(test_dataloader))
+    elapsed, n_images = 0, 0
+    n_screened, n_anomalous, n_missed = 0, 0, 0
+    anomalous_margins = []
 
-    for i in range(num_batches_to_process):
-        try:
-            batch = next(test_iter)
-        except StopIteration:
-            print("Test dataloader exhausted before processing all requested batches.")
-            break
-        inputs = batch['image'].to(device)
-        gt = batch['gt'].cpu()
-
-        score_map = get_score_map(inputs, teacher, students, params).cpu()
-        y_score = np.concatenate((y_score, rearrange(score_map, 'b h w -> (b h w)').numpy()))
-        y_true = np.concatenate((y_true, rearrange(gt, 'b c h w -> (b c h w)').numpy()))
-
-        if args.visualize:
-            unorm = transforms.Normalize((-1, -1, -1), (2, 2, 2)) # get back to original image
-            max_score = (params['students']['err']['max'] - params['students']['err']['mu']) / torch.sqrt(params['students']['err']['var'])\
-                + (params['students']['var']['max'] - params['students']['var']['mu']) / torch.sqrt(params['students']['var']['var']).item()
-            img_in = rearrange(unorm(inputs).cpu(), 'b c h w -> b h w c')
-            gt_in = rearrange(gt, 'b c h w -> b h w c')
-
-            for b in range(args.batch_size):
-                # Construct save path for the current image
-
-                save_filename = f"anomaly_batch{i}_img{b}.png"
+    # the worker threads of --multiscale are released even if scoring fails
+    try:
+        for i in range(num_batches_to_process):
+            try:
+                batch = next(test_iter)
+            except StopIteration:
+                print("Test dataloader exhausted before processing all requested batches.")
+                break
+            inputs = batch['image'].to(device)
+            gt = batch['gt'].cpu()
+
+            start = time.perf_counter()
+            if screen is not None:
+                # only the suspicious images get the full scoring, the others get the
+                # floor of its scale rather than their screen map, on another scale
+                screen_teacher, screen_students, screen_params, threshold = screen
+                with autocast(device, args.precision):
+                    image_scores, keep = screen_images(inputs, screen_teacher, screen_students, screen_params,
+                                                       threshold, args.screen_size, max_memory, args.engine)
+                image_scores, keep = image_scores.float().cpu(), keep.cpu()
+                score_map = torch.full((inputs.size(0),) + inputs.shape[2:], min_score)
+                if keep.any():
+                    score_map[keep] = score(inputs[keep.to(device)])
+                anomalous = batch['label'] == 1
+                n_screened += int((~keep).sum())
+                n_anomalous += int(anomalous.sum())
+                n_missed += int((~keep & anomalous).sum())
+                # largest --screen_margin keeping the anomalous images
+                anomalous_margins.append(image_scores[anomalous] / screen_params['screen']['max'])
+            else:
+                score_map = score(inputs)
+            elapsed += time.perf_counter() - start
+            n_images += inputs.size(0)
+            if roi is not None:
+                # pixels outside of the region of interest are not scored
+                mask = roi_mask(roi, inputs.size(2), inputs.size(3))
+                y_score = np.concatenate((y_score, score_map[:, mask].flatten().numpy()))
+                y_true = np.concatenate((y_true, gt[:, 0, mask].flatten().numpy()))
+            else:
+                y_score = np.concatenate((y_score, rearrange(score_map, 'b h w -> (b h w)').numpy()))
+                y_true = np.concatenate((y_true, rearrange(gt, 'b c h w -> (b c h w)').numpy()))
+
+            if args.visualize:
+                unorm = transforms.Normalize((-1, -1, -1), (2, 2, 2)) # get back to original image
+                img_in = rearrange(unorm(inputs).cpu(), 'b c h w -> b h w c')
+                gt_in = rearrange(gt, 'b c h w -> b h w c')
+
+                for b in range(inputs.size(0)):
+                    # Construct save path for the current image
+
+                    save_filename = f"anomaly_batch{i}_img{b}.png"
                 
-                full_save_path = os.path.join(save_dir, save_filename)
-
-                visualize(img_in[b, :, :, :].squeeze(), 
-                          gt_in[b, :, :, :].squeeze(), 
-                          score_map[b, :, :].squeeze(), 
-                          max_score,
-                          save_path=full_save_path,
-                          show_plot=False) # Set to True if you still want to see plots interactively
-    
+                    full_save_path = os.path.join(save_dir, save_filename)
+
+                    visualize(img_in[b, :, :, :].squeeze(), 
+                              gt_in[b, :, :, :].squeeze(), 
+                              score_map[b, :, :].squeeze(), 
+                              max_score,
+                              save_path=full_save_path,
+                              show_plot=False) # Set to True if you still want to see plots interactively
+    finally:
+        if multiscale is not None:
+            multiscale.close()
+
+    if n_images:
+        print(f'Scored {n_images} images in {elapsed:.1f} s ({n_images / elapsed:.2f} img/s, {args.precision})')
+    if students_used:
+        print(f'Progressive evaluation: {torch.cat(students_used).float().mean():.2f} of {args.n_students} students per image')
+    if screen is not None and n_images:
+        print(f'Cascade: {n_screened}/{n_images} images short-circuited ({100 * n_screened / n_images:.1f}%), '
+              f'{n_missed}/{n_anomalous} anomalous images among them '
+              f'(recall cost {100 * n_missed / max(n_anomalous, 1):.1f}%)')
+        # recall of the cascade with other margins, on the same test images
+        margins = torch.cat(anomalous_margins).sort().values
+        for k in sorted({int(q * margins.numel()) for q in [0, 0.05, 0.1]}) if margins.numel() else []:
+            print(f'  --screen_margin {margins[k]:.3f} keeps {margins.numel() - k}/{margins.numel()} anomalous images')
+
     # AUC ROC
     """
     from sklearn.metrics import roc_curve, auc
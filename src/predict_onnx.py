@@ -0,0 +1,160 @@
+'''
+Anomaly detection on the test images of a dataset with the ONNX scorer of
+export_onnx.py, run by onnxruntime on CPU.
+
+Only numpy, PIL, onnxruntime (and scikit-learn for the ROC AUC) are
+imported, PyTorch is not needed at inference time. The images are read
+and resized as transforms.Resize does. The scorer settings (engine, memory
+budget, students) are fixed at export time, they are read from the
+metadata file written next to the graph, with a fingerprint of the weights
+and of the calibration: a graph exported before they changed is refused.
+
+    python predict_onnx.py --dataset carpet --patch_size 33 --image_size 256
+'''
+
+import os
+import csv
+import json
+import hashlib
+import time
+import numpy as np
+from PIL import Image
+from argparse import ArgumentParser
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset to infer on (in data folder)")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
+    parser.add_argument('--image_size', type=int, default=256, help="Input size the scorer was exported for")
+    parser.add_argument('--test_size', type=int, default=89, help="Number of batch for the test set")
+    parser.add_argument('--n_threads', type=int, default=0, help="onnxruntime intra-op threads, 0 lets onnxruntime choose")
+    parser.add_argument('--save_dir', type=str, default=None, help="Folder to save the score maps to, as images")
+
+    args = parser.parse_args()
+    return args
+
+
+def onnx_path(args):
+    return f'../model/{args.dataset}/scorer_{args.patch_size}_{args.image_size}.onnx'
+
+
+def metadata_path(path):
+    '''Settings of an exported scorer, saved next to it by export_onnx.py.'''
+    return path.replace('.onnx', '.json')
+
+
+def weights_fingerprint(dataset, patch_size, n_students, calibration_file):
+    '''Hash of the weights and of the calibration an exported scorer was built from.'''
+    sha = hashlib.sha256()
+    model_files = [f'../model/{dataset}/teacher_{patch_size}_net.pt'] + \
+                  [f'../model/{dataset}/student_{patch_size}_net_{i}.pt' for i in range(n_students)] + \
+                  [calibration_file]
+    for model_file in model_files:
+        if os.path.exists(model_file):
+            with open(model_file, 'rb') as f:
+                sha.update(f.read())
+        else:
+            sha.update(f'missing {model_file}'.encode())
+    return sha.hexdigest()
+
+
+def load_onnx_scorer(path, n_threads=0):
+    '''onnxruntime CPU session of an exported scorer, all graph optimizations enabled.
+    n_threads: intra-op threads, 0 lets onnxruntime choose.'''
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = n_threads
+    session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    print(f'Loading of ONNX scorer {path} succesful.')
+    return session
+
+
+def onnx_score_map(session, inputs):
+    '''Score map (b, h, w) of a numpy batch (b, 3, h, w) with an exported scorer,
+    the last (smaller) batch of a dataset is padded with zeros.'''
+    shape = session.get_inputs()[0].shape
+    n = inputs.shape[0]
+    if n < shape[0]:
+        inputs = np.concatenate([inputs, np.zeros((shape[0] - n,) + inputs.shape[1:], dtype=inputs.dtype)])
+    return session.run(None, {'image': inputs.astype(np.float32)})[0][:n]
+
+
+def load_image(path, size):
+    '''(3, size, size) image normalized to [-1, 1], as Resize, ToTensor and Normalize.'''
+    image = Image.open(path).convert('RGB').resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 127.5 - 1
+
+
+def load_gt(path, size):
+    '''(size, size) ground truth in [0, 1], zeros when there is none.'''
+    if not path:
+        return np.zeros((size, size), dtype=np.float32)
+    gt = Image.open(path).convert('L').resize((size, size), Image.BILINEAR)
+    return np.asarray(gt, dtype=np.float32) / 255
+
+
+def test_batches(root_dir, size, batch_size):
+    '''Batches (images, gts, labels, names) of the test images of a dataset.'''
+    dataset = os.path.basename(os.path.normpath(root_dir))
+    with open(os.path.join(root_dir, dataset + '.csv')) as f:
+        items = [row for row in csv.DictReader(f) if row['type'] == 'test']
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        images = np.stack([load_image(os.path.join(root_dir, 'img', item['image_name']), size) for item in batch])
+        gts = np.stack([load_gt(item['gt_name'] and os.path.join(root_dir, 'ground_truth', item['gt_name']), size)
+                        for item in batch])
+        yield images, gts, [int(item['label']) for item in batch], [item['image_name'] for item in batch]
+
+
+def predict_onnx(args):
+    path = onnx_path(args)
+    if not os.path.exists(path):
+        print(f"ONNX scorer {path} not found. Please run export_onnx.py first.")
+        return
+    with open(metadata_path(path)) as f:
+        metadata = json.load(f)
+    if metadata.get('fingerprint') != weights_fingerprint(args.dataset, args.patch_size, metadata['n_students'],
+                                                          metadata['calibration_file']):
+        print(f"ONNX scorer {path} is out of date. Please run export_onnx.py again.")
+        return
+    print(f"Scorer exported with {metadata['n_students']} students, {metadata['engine']} engine, "
+          f"batches of {metadata['batch_size']}")
+    session = load_onnx_scorer(path, args.n_threads)
+
+    if args.save_dir:
+        import matplotlib.pyplot as plt
+        os.makedirs(args.save_dir, exist_ok=True)
+
+    y_score, y_true = [], []
+    elapsed, n_images = 0, 0
+    batches = test_batches(f'../data/{args.dataset}', args.image_size, metadata['batch_size'])
+    for i, (images, gts, labels, names) in enumerate(batches):
+        if i >= args.test_size:
+            break
+        start = time.perf_counter()
+        score_map = onnx_score_map(session, images)
+        elapsed += time.perf_counter() - start
+        n_images += len(images)
+        y_score.append(score_map.ravel())
+        y_true.append(gts.ravel())
+
+        if args.save_dir:
+            for name, image_map in zip(names, score_map):
+                plt.imsave(os.path.join(args.save_dir, f'score_{os.path.splitext(name)[0]}.png'),
+                           image_map, vmin=0, vmax=metadata['max_score'], cmap='jet')
+
+    if n_images:
+        print(f'Scored {n_images} images in {elapsed:.1f} s ({n_images / elapsed:.2f} img/s, onnxruntime)')
+        y_score, y_true = np.concatenate(y_score), np.concatenate(y_true) > 0.5
+        if 0 < y_true.sum() < y_true.size:
+            from sklearn.metrics import roc_auc_score
+            print(f'Pixel ROC AUC: {roc_auc_score(y_true, y_score):.4f}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    predict_onnx(args)
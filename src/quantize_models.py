@@ -0,0 +1,155 @@
+'''
+INT8 post-training quantization of the teacher and the students of a dataset.
+
+The activation ranges are observed on the anomaly-free train images, the
+quantized networks are saved next to the fp32 ones (*_int8.pt, with the
+quantized engine --backend they are packed for) and recalibrated, their
+scoring parameters are saved in calibration_{p}_int8.pkl.
+predict_anomaly.py and calibrate_models.py load them with --quantized.
+
+Unless --test_size is 0, the fp32 and the INT8 models are then compared
+on the test set: time per image and pixel-level ROC AUC.
+
+    python quantize_models.py --dataset carpet --patch_size 33 --n_students 3
+'''
+
+import time
+import torch
+import numpy as np
+import pickle
+import os
+from argparse import ArgumentParser
+from itertools import islice
+from AnomalyDataset import AnomalyDataset
+from torchvision import transforms
+from torch.utils.data.dataloader import DataLoader
+from sklearn.metrics import roc_auc_score
+from QuantizedAnomalyNet import quantize_net
+from anomaly_detection import calibrate, get_tiled_score_map
+from utils import load_models, quantized_model_path, params_to
+
+
+def parse_arguments():
+    parser = ArgumentParser()
+
+    # program arguments
+    parser.add_argument('--dataset', type=str, default='carpet', help="Dataset the models were trained on")
+    parser.add_argument('--n_students', type=int, default=3, help="Number of students network to use")
+    parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65])
+    parser.add_argument('--image_size', type=int, default=256, help="Size images are resized to, 0 keeps their native size")
+    parser.add_argument('--calibration_size', type=int, default=16, help="Number of batches to observe the activation ranges on")
+    parser.add_argument('--test_size', type=int, default=20, help="Number of test batches of the fp32/INT8 report, 0 to skip it")
+    parser.add_argument('--max_memory', type=int, default=None, help="Peak memory (MiB) when scoring, images are tiled to fit")
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'], help="Quantized engine")
+
+    # trainer arguments
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=4)
+
+    args = parser.parse_args()
+    return args
+
+
+def model_paths(args):
+    return [f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt'] + \
+           [f'../model/{args.dataset}/student_{args.patch_size}_net_{i}.pt' for i in range(args.n_students)]
+
+
+@torch.no_grad()
+def evaluate(teacher, students, params, dataloader, test_size, max_memory=None):
+    '''Mean time per image (s) and pixel-level ROC AUC on test_size batches.'''
+    y_score, y_true = [], []
+    elapsed, n_images = 0, 0
+    for batch in islice(dataloader, test_size):
+        inputs = batch['image']
+        start = time.perf_counter()
+        score_map = get_tiled_score_map(inputs, teacher, students, params, max_memory)
+        elapsed += time.perf_counter() - start
+        n_images += inputs.size(0)
+        y_score.append(score_map.flatten().numpy())
+        y_true.append(batch['gt'].flatten().numpy())
+    y_score, y_true = np.concatenate(y_score), np.concatenate(y_true) > 0.5
+    auc = roc_auc_score(y_true, y_score) if 0 < y_true.sum() < y_true.size else float('nan')
+    return elapsed / n_images, auc
+
+
+def quantize_models(args):
+    # INT8 kernels are CPU only
+    device = torch.device('cpu')
+    # the weights are packed for this engine, set once for the whole run
+    torch.backends.quantized.engine = args.backend
+
+    # images are scored at their native size when image_size is 0
+    resize = [transforms.Resize((args.image_size, args.image_size))] if args.image_size else []
+
+    # calibration on anomaly-free dataset
+    calib_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                                   transform=transforms.Compose([
+                                        *resize,
+                                        transforms.ToTensor(),
+                                        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
+                                   type='train',
+                                   label=0)
+
+    calib_dataloader = DataLoader(calib_dataset,
+                                  batch_size=args.batch_size,
+                                  shuffle=False,
+                                  num_workers=args.num_workers)
+
+    teacher, students = load_models(args.dataset, args.patch_size, args.n_students, device)
+
+    print('Observing activation ranges on the anomaly-free train images...')
+    batches = [batch['image'] for batch in islice(calib_dataloader, args.calibration_size)]
+    qnets = [quantize_net(net, batches) for net in [teacher] + students]
+    for qnet, model_path in zip(qnets, model_paths(args)):
+        torch.save({'engine': args.backend, 'state_dict': qnet.state_dict()}, quantized_model_path(model_path))
+        print(f'Quantized model saved to {quantized_model_path(model_path)}')
+    q_teacher, q_students = qnets[0], qnets[1:]
+
+    print('Calibrating the quantized models...')
+    max_memory = args.max_memory * 2**20 if args.max_memory else None
+    q_params = calibrate(q_teacher, q_students, calib_dataloader, device, max_memory)
+    calibration_file = f'../model/{args.dataset}/calibration_{args.patch_size}_int8.pkl'
+    with open(calibration_file, 'wb') as f:
+        pickle.dump(q_params, f)
+    print(f'Calibration parameters saved to {calibration_file}')
+
+    if not args.test_size:
+        return
+
+    # fp32 reference
+    calibration_file = f'../model/{args.dataset}/calibration_{args.patch_size}.pkl'
+    if os.path.exists(calibration_file):
+        with open(calibration_file, 'rb') as f:
+            params = params_to(pickle.load(f), device)
+    else:
+        params = calibrate(teacher, students, calib_dataloader, device, max_memory)
+
+    test_dataset = AnomalyDataset(root_dir=f'../data/{args.dataset}',
+                                  transform=transforms.Compose([
+                                    *resize,
+                                    transforms.ToTensor(),
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
+                                  gt_transform=transforms.Compose([
+                                    *resize,
+                                    transforms.ToTensor()]),
+                                  type='test')
+
+    test_dataloader = DataLoader(test_dataset,
+                                 batch_size=args.batch_size,
+                                 shuffle=False,
+                                 num_workers=args.num_workers)
+
+    fp32_time, fp32_auc = evaluate(teacher, students, params, test_dataloader, args.test_size, max_memory)
+    int8_time, int8_auc = evaluate(q_teacher, q_students, q_params, test_dataloader, args.test_size, max_memory)
+
+    print(f'\nAnomalyNet{args.patch_size}, {args.n_students} students, {args.test_size} test batches')
+    print(f'{"":<6} {"s/img":>8} {"ROC AUC":>8}')
+    print(f'{"fp32":<6} {fp32_time:8.3f} {fp32_auc:8.4f}')
+    print(f'{"int8":<6} {int8_time:8.3f} {int8_auc:8.4f}')
+    print(f'speedup x{fp32_time / int8_time:.2f}, ROC AUC drift {int8_auc - fp32_auc:+.4f}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    quantize_models(args)
@@ -1,16 +1,23 @@
+import os
+import shutil
+import hashlib
 import torch
 import torchvision.models as models
 import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from einops import reduce
-from AnomalyNet import AnomalyNet
+from AnomalyNet import AnomalyNet, DeployedAnomalyNet
 from AnomalyDataset import AnomalyDataset
 from torchvision import transforms
+from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
 from torch.utils.data.dataloader import DataLoader
 from utils import increment_mean_and_var, load_model
+from augmentation import to_rgb, students_augmentation
 
 
 def parse_arguments():
@@ -21,6 +28,12 @@ def parse_arguments():
     parser.add_argument('--n_students', type=int, default=3, help="Number of students network to train")
     parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65], help="Height and width of patch CNN")
     parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--packed', action='store_true', help="Read the images packed at image_size (see pack_dataset) instead of the PNG files")
+    parser.add_argument('--concurrent', action='store_true', help="Train all the students in one pass over the data, the teacher runs once per batch")
+    parser.add_argument('--shared_batches', action='store_true', help="With --concurrent, the students train on the same batches instead of their own shuffles: the teacher runs on one batch per step instead of n_students (--cache_targets removes that cost without sharing)")
+    parser.add_argument('--student_workers', type=int, default=1, help="Number of students updated in parallel threads with --concurrent")
+    parser.add_argument('--batch_augment', action='store_true', help="Flip whole batches on the device, the workers only decode the images")
+    parser.add_argument('--cache_targets', action='store_true', help="Read the teacher targets of the 4 flips of every image from a float16 cache (h*w*4 KiB per image)")
 
     # trainer arguments
     parser.add_argument('--max_epochs', type=int, default=15)
@@ -41,6 +54,179 @@ def student_loss(output, target):
     return loss
 
 
+# flips of an image (c, h, w) or a batch (b, c, h, w): none, horizontal, vertical, both
+FLIPS = [(), (-1,), (-2,), (-2, -1)]
+
+
+def targets_cache_file(args, image_files):
+    '''Cache of the teacher targets, keyed by the teacher weights and by the
+    training images, in dataset order (their rows in the cache). None
+    without a teacher checkpoint: the random teacher of load_model changes
+    from one run to the next, its targets are not worth caching.'''
+    teacher_file = f'../model/{args.dataset}/teacher_{args.patch_size}_net.pt'
+    if not os.path.exists(teacher_file):
+        print(f'No teacher checkpoint {teacher_file}, the teacher targets are not cached.')
+        return None
+    sha = hashlib.sha256()
+    with open(teacher_file, 'rb') as f:
+        sha.update(f.read())
+    sha.update(repr(args.image_size).encode())
+    for image_file in image_files:
+        # replaced or reordered images give another cache
+        stat = os.stat(image_file)
+        sha.update(repr((os.path.basename(image_file), stat.st_size, stat.st_mtime_ns)).encode())
+    return f'../model/{args.dataset}/teacher_{args.patch_size}_targets_{sha.hexdigest()[:16]}.npy'
+
+
+@torch.no_grad()
+def cache_teacher_targets(teacher, dataset, cache_file, batch_size, num_workers, device):
+    '''Normalized targets of the teacher for every image of dataset and
+    each of its FLIPS, saved as a float16 (N, 4, h, w, 512) array.'''
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    h, w = dataset[0]['image'].shape[1:]
+    # written under another name, an interrupted run leaves no partial cache
+    tmp_file = cache_file + '.tmp'
+    targets = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float16,
+                                        shape=(len(dataset), len(FLIPS), h, w, teacher.net.decode.out_features))
+    i = 0
+    for batch in tqdm(dataloader):
+        inputs = batch['image'].to(device)
+        for j, dims in enumerate(FLIPS):
+            flipped = torch.flip(inputs, dims) if dims else inputs
+            targets[i:i + inputs.size(0), j] = teacher.fdfe(flipped).half().cpu().numpy()
+        i += inputs.size(0)
+    targets.flush()
+    del targets
+    os.replace(tmp_file, cache_file)
+
+
+def check_free_space(path, size):
+    '''Fail before writing size bytes to the folder of path if they do not fit.'''
+    folder = os.path.dirname(path) or '.'
+    free = shutil.disk_usage(folder).free
+    if size > free:
+        raise RuntimeError(f'{path} needs {size / 2**30:.1f} GiB, only {free / 2**30:.1f} GiB are free in {folder}.')
+
+
+class CachedTargetsDataset(Dataset):
+    '''Images of dataset with their teacher targets, read from the cache of
+    cache_teacher_targets. One of the FLIPS is drawn for each sample.'''
+
+    def __init__(self, dataset, cache_file):
+        super(CachedTargetsDataset, self).__init__()
+        self.dataset = dataset
+        self.cache_file = cache_file
+        # memory map opened on first access, in each DataLoader worker
+        self.targets = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['targets'] = None
+        return state
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self.targets is None:
+            self.targets = np.load(self.cache_file, mmap_mode='r')
+        j = int(torch.randint(len(FLIPS), ()))
+        image = self.dataset[idx]['image']
+        dims = FLIPS[j]
+        return {'image': torch.flip(image, dims) if dims else image,
+                'targets': torch.from_numpy(np.array(self.targets[idx, j]))}
+
+
+def get_inputs(batch, device, batch_augment=False):
+    '''Training images of a batch on device, augmented there when
+    batch_augment (the dataset then gives uint8 images).'''
+    inputs = batch['image'].to(device)
+    return students_augmentation(inputs) if batch_augment else inputs
+
+
+def train_step(student, optimizer, inputs, targets):
+    '''One optimization step of a student, returns its loss.'''
+    # zero the parameters gradient
+    optimizer.zero_grad()
+
+    # forward pass
+    outputs = student.fdfe(inputs)
+    loss = student_loss(targets, outputs)
+
+    # backward pass
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+class StudentsBatchSampler(Sampler):
+    '''Batches of concurrent student training: the concatenation of one
+    batch of every student, each drawn from its own shuffle of the dataset,
+    or a single batch shared by all the students.'''
+
+    def __init__(self, n_images, batch_size, n_students, shared=False):
+        self.n_images = n_images
+        self.batch_size = batch_size
+        self.n_students = n_students
+        self.shared = shared
+
+    def __iter__(self):
+        permutations = [torch.randperm(self.n_images) for _ in range(1 if self.shared else self.n_students)]
+        for start in range(0, self.n_images, self.batch_size):
+            yield torch.cat([p[start:start + self.batch_size] for p in permutations]).tolist()
+
+    def __len__(self):
+        return -(-self.n_images // self.batch_size)
+
+
+def train_concurrent(args, teacher, students, optimizers, dataset, cache_file, device):
+    '''Train every student in the same pass over the data: each batch is
+    loaded once and the teacher runs once on it, then every student is
+    updated on its part of the batch, or on the whole batch with
+    shared_batches (see StudentsBatchSampler), in student_workers threads.'''
+    n_students = len(students)
+    dataloader = DataLoader(dataset,
+                            batch_sampler=StudentsBatchSampler(len(dataset), args.batch_size, n_students, args.shared_batches),
+                            num_workers=args.num_workers)
+    executor = ThreadPoolExecutor(args.student_workers) if args.student_workers > 1 else None
+    model_names = [f'/content/drive/MyDrive/data/{args.dataset}/student_{args.patch_size}_net_{j}.pt' for j in range(n_students)]
+    min_running_loss = [np.inf] * n_students
+    print(f'Training {n_students} students concurrently on anomaly-free dataset ...')
+
+    for epoch in range(args.max_epochs):
+        running_loss = [0.0] * n_students
+
+        for i, batch in tqdm(enumerate(dataloader)):
+            inputs = get_inputs(batch, device, args.batch_augment)
+            if cache_file:
+                targets = batch['targets'].to(device).float()
+            else:
+                with torch.no_grad():
+                    targets = teacher.fdfe(inputs)
+
+            if args.shared_batches:
+                inputs, targets = [inputs] * n_students, [targets] * n_students
+            else:
+                inputs = inputs.split(inputs.size(0) // n_students)
+                targets = targets.split(targets.size(0) // n_students)
+            steps = (executor.map if executor else map)(train_step, students, optimizers, inputs, targets)
+            for j, loss in enumerate(steps):
+                running_loss[j] += loss
+
+            # print stats
+            if i % 10 == 9:
+                for j, student in enumerate(students):
+                    print(f"Student {j}, epoch {epoch+1}, iter {i+1} \t loss: {running_loss[j]}")
+
+                    if running_loss[j] < min_running_loss[j] and epoch > 0:
+                        torch.save(student.state_dict(), model_names[j])
+                        print(f"Loss decreased: {min_running_loss[j]} -> {running_loss[j]}.")
+                        print(f"Model saved to {model_names[j]}.")
+
+                    min_running_loss[j] = min(min_running_loss[j], running_loss[j])
+                    running_loss[j] = 0.0
+
+
 def train(args):
     # Choosing device 
     device = torch.device("cuda:0" if args.gpus else "cpu")
@@ -67,34 +253,67 @@ def train(args):
                             lr=args.learning_rate, 
                             weight_decay=args.weight_decay) for student in students]
 
-    # Load anomaly-free training data
+    if args.batch_augment and args.cache_targets:
+        raise ValueError('The cached targets come with their own flips, --batch_augment does not apply.')
+
+    train_images = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}', type='train', label=0)
+    image_files = [os.path.join(train_images.img_dir, name) for name in train_images.frame_list['image_name']]
+    n_images = len(image_files)
+    cache_file = targets_cache_file(args, image_files) if args.cache_targets else None
+    if cache_file and not os.path.exists(cache_file):
+        # float16 targets of the 4 flips of every image
+        check_free_space(cache_file, n_images * len(FLIPS) * args.image_size**2 * teacher.decode.out_features * 2)
+
+    # Load anomaly-free training data, the cached targets come with their flips,
+    # uint8 images are flipped by batch with batch_augment
+    flips = [] if cache_file else [transforms.RandomHorizontalFlip(), transforms.RandomVerticalFlip()]
+    to_tensor = [transforms.Lambda(to_rgb), transforms.PILToTensor()] if args.batch_augment else \
+                [*flips, transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
     dataset = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
                              transform=transforms.Compose([
                                 transforms.Resize((args.image_size, args.image_size)),
-                                transforms.RandomHorizontalFlip(),
-                                transforms.RandomVerticalFlip(),
-                                transforms.ToTensor(),
-                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
+                                *to_tensor]),
+                             packed_size=args.image_size if args.packed else None,
                              type='train',
                              label=0)
     
 
-    # Preprocessing
-    # Apply teacher network on anomaly-free dataset
-    dataloader = DataLoader(dataset, 
-                            batch_size=args.batch_size, 
-                            shuffle=False, 
-                            num_workers=args.num_workers)
-    print(f'Preprocessing of training dataset {args.dataset}...')
+    if cache_file and os.path.exists(cache_file):
+        print(f'Loading teacher targets from {cache_file}')
+    else:
+        # Preprocessing
+        # Apply teacher network on anomaly-free dataset
+        dataloader = DataLoader(dataset, 
+                                batch_size=args.batch_size, 
+                                shuffle=False, 
+                                num_workers=args.num_workers)
+        print(f'Preprocessing of training dataset {args.dataset}...')
 
-    # Compute incremental mean and var over traininig set
-    # because the whole training set takes too much memory space 
-    with torch.no_grad():
-        t_mu, t_var, N = 0, 0, 0
-        for i, batch in tqdm(enumerate(dataloader)):
-            inputs = batch['image'].to(device)
-            t_out = teacher.fdfe(inputs)
-            t_mu, t_var, N = increment_mean_and_var(t_mu, t_var, N, t_out)
+        # Compute incremental mean and var over traininig set
+        # because the whole training set takes too much memory space.
+        # The cached images are not flipped by the dataset, the statistics
+        # are taken over their 4 FLIPS, the distribution of the random flips
+        with torch.no_grad():
+            t_mu, t_var, N = 0, 0, 0
+            for i, batch in tqdm(enumerate(dataloader)):
+                inputs = get_inputs(batch, device, args.batch_augment)
+                for dims in FLIPS if cache_file else [()]:
+                    t_out = teacher.fdfe(torch.flip(inputs, dims) if dims else inputs)
+                    t_mu, t_var, N = increment_mean_and_var(t_mu, t_var, N, t_out)
+
+        # normalization of the targets folded into the teacher
+        teacher = DeployedAnomalyNet(teacher, t_mu, t_var)
+
+        if cache_file:
+            print(f'Caching teacher targets to {cache_file}...')
+            cache_teacher_targets(teacher, dataset, cache_file, args.batch_size, args.num_workers, device)
+
+    if cache_file:
+        dataset = CachedTargetsDataset(dataset, cache_file)
+
+    if args.concurrent:
+        train_concurrent(args, teacher, students, optimizers, dataset, cache_file, device)
+        return
 
     # Training
     dataloader = DataLoader(dataset, 
@@ -111,20 +330,13 @@ def train(args):
             running_loss = 0.0
 
             for i, batch in tqdm(enumerate(dataloader)):
-                # zero the parameters gradient
-                optimizers[j].zero_grad()
-
-                # forward pass
-                inputs = batch['image'].to(device)
-                with torch.no_grad():
-                    targets = (teacher.fdfe(inputs) - t_mu) / torch.sqrt(t_var)
-                outputs = student.fdfe(inputs)
-                loss = student_loss(targets, outputs)
-
-                # backward pass
-                loss.backward()
-                optimizers[j].step()
-                running_loss += loss.item()
+                inputs = get_inputs(batch, device, args.batch_augment)
+                if cache_file:
+                    targets = batch['targets'].to(device).float()
+                else:
+                    with torch.no_grad():
+                        targets = teacher.fdfe(inputs)
+                running_loss += train_step(student, optimizers[j], inputs, targets)
 
                 # print stats
                 if i % 10 == 9:
@@ -1,3 +1,8 @@
+import os
+import json
+import hashlib
+import queue
+import threading
 import torch
 import torchvision.models as models
 import torch.nn as nn
@@ -10,8 +15,11 @@ from AnomalyNet import AnomalyNet
 from AnomalyResnet18 import AnomalyResnet18
 from AnomalyDataset import AnomalyDataset
 from torchvision import transforms
+from torch.utils.data.dataset import Dataset
 from torch.utils.data.dataloader import DataLoader
+from functools import partial
 from utils import load_model
+from augmentation import to_rgb, normalize, teacher_augmentation
 
 
 def parse_arguments():
@@ -21,9 +29,16 @@ def parse_arguments():
     parser.add_argument('--dataset', type=str, default='carpet', help="Dataset to train on (in data folder)")
     parser.add_argument('--patch_size', type=int, default=65, choices=[17, 33, 65], help="Height and width of patch CNN")
     parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--packed', action='store_true', help="Read the images packed at image_size (see pack_dataset) instead of the PNG files")
+    parser.add_argument('--patches_per_image', type=int, default=1, help="Number of patches drawn from each decoded image, batches keep batch_size patches")
+    parser.add_argument('--batch_augment', action='store_true', help="Crop, flip and rotate whole batches on the device, the workers only decode the images")
 
     # trainer arguments
     parser.add_argument('--max_epochs', type=int, default=1000)
+    parser.add_argument('--max_steps', type=int, default=0, help="Train for this number of steps on an endless patch stream from the images kept in RAM, instead of epochs")
+    parser.add_argument('--checkpoint_steps', type=int, default=100, help="Number of steps between two checkpoints with --max_steps")
+    parser.add_argument('--queue_size', type=int, default=8, help="Number of batches produced ahead with --max_steps")
+    parser.add_argument('--target_bank', action='store_true', help="With --max_steps, train on the patches and targets of build_target_bank.py, ResNet18 is not run")
     parser.add_argument('--gpus', type=int, default=(1 if torch.cuda.is_available() else 0))
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--num_workers', type=int, default=4)
@@ -53,18 +68,235 @@ def compactness_loss(output):
     return loss
 
 
-def train(args):
-    # Choosing device 
-    device = torch.device("cuda:0" if args.gpus else "cpu")
-    print(f'Device used: {device}')
+def patch_transform(patch_size):
+    '''Augmentation of a training patch, applied after the image resizing.'''
+    return transforms.Compose([
+        transforms.RandomCrop((patch_size, patch_size)),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomVerticalFlip(),
+        transforms.RandomRotation(180),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+
+class MultiPatchDataset(Dataset):
+    '''n_patches patches (n_patches, 3, p, p) of each image of dataset, the
+    image being decoded and resized once by the transform of dataset.
+    Each patch is drawn and augmented independently by transform, so the
+    patches follow the same distribution as with one patch per image.'''
+
+    def __init__(self, dataset, transform, n_patches):
+        super(MultiPatchDataset, self).__init__()
+        self.dataset = dataset
+        self.transform = transform
+        self.n_patches = n_patches
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        image = sample['image']
+        sample['image'] = torch.stack([self.transform(image) for _ in range(self.n_patches)])
+        return sample
+
+
+def load_image_bank(args):
+    '''Training images resized to image_size, as a uint8 (N, 3, h, w) tensor kept in RAM.'''
+    dataset = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
+                             transform=transforms.Compose([
+                                transforms.Resize((args.image_size, args.image_size)),
+                                transforms.Lambda(to_rgb),
+                                transforms.PILToTensor()]),
+                             gt_transform=None,
+                             packed_size=args.image_size if args.packed else None,
+                             type='train')
+    dataloader = DataLoader(dataset, batch_size=16, num_workers=args.num_workers)
+    return torch.cat([batch['image'] for batch in dataloader])
 
-    # Pretrained network for knowledge distillation
+
+class PatchStream:
+    '''Endless stream of training batches, augment(images) being called on
+    n_images images of the bank drawn with replacement, eg: patches of
+    teacher_augmentation. A background thread produces them into a queue
+    holding queue_size batches, it lives until close is called.'''
+
+    def __init__(self, bank, augment, n_images, queue_size=8):
+        self.bank = bank
+        self.augment = augment
+        self.n_images = n_images
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            while not self.stopped.is_set():
+                index = torch.randint(len(self.bank), (self.n_images,))
+                self._put(self.augment(self.bank[index]))
+        except Exception as e:
+            # raised again by the consumer
+            self._put(e)
+
+    def _put(self, item):
+        # the queue is full most of the time, the stop event is checked while waiting
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def load_resnet18(dataset, device):
+    '''Frozen ResNet18 of the targets, (b, 512, 1, 1) descriptors.'''
     resnet18 = AnomalyResnet18()
-    resnet_model = f'../model/{args.dataset}/resnet18.pt'
+    resnet_model = f'../model/{dataset}/resnet18.pt'
     load_model(resnet18, resnet_model)
 
     resnet18 = nn.Sequential(*list(resnet18.children())[:-2])
-    resnet18.eval().to(device)
+    return resnet18.eval().to(device)
+
+
+def resnet18_fingerprint(dataset):
+    '''sha256 of the ResNet18 weights of load_resnet18, None without them.'''
+    resnet_model = f'../model/{dataset}/resnet18.pt'
+    if not os.path.exists(resnet_model):
+        return None
+    sha = hashlib.sha256()
+    with open(resnet_model, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def target_bank_dir(dataset, patch_size, image_size):
+    '''Folder of the target bank of build_target_bank.py.'''
+    return f'../model/{dataset}/target_bank_{patch_size}_{image_size}'
+
+
+class TargetBank:
+    '''Patches and ResNet18 targets of build_target_bank.py, memory-mapped:
+    uint8 (N, 3, p, p) patches.npy and float16 (N, 512) targets.npy, and
+    the settings they were drawn with in bank.json, checked against
+    the expected ones (eg: patch_size=65, image_size=256, resnet18=<sha256>).
+    Indexed by a tensor of rows, it gives the normalized patches and their
+    float targets, a PatchStream source.'''
+
+    def __init__(self, path, **expected):
+        metadata_file = os.path.join(path, 'bank.json')
+        if not os.path.exists(metadata_file):
+            raise ValueError(f'{metadata_file} not found, (re)build the bank with build_target_bank.py.')
+        with open(metadata_file) as f:
+            self.metadata = json.load(f)
+        for key, value in expected.items():
+            if self.metadata.get(key) != value:
+                raise ValueError(f'Target bank {path} was built with {key}={self.metadata.get(key)}, expected {value}.')
+        self.patches = np.load(os.path.join(path, 'patches.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(path, 'targets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.patches)
+
+    def __getitem__(self, index):
+        # rows read in file order
+        index = np.sort(index.numpy())
+        return normalize(torch.from_numpy(self.patches[index])), torch.from_numpy(self.targets[index]).float()
+
+
+def patch_targets(resnet18, inputs):
+    '''ResNet18 descriptor (b, 512) of each patch of a batch.'''
+    with torch.no_grad():
+        return rearrange(resnet18(inputs), 'b vec h w -> b (vec h w)') # h=w=1
+        #return torch.squeeze(resnet18(inputs))
+
+
+def train_step(teacher, optimizer, inputs, targets):
+    '''One optimization step of the teacher, returns its loss.'''
+    # zero the parameters gradient
+    optimizer.zero_grad()
+
+    # forward pass
+    outputs = teacher(inputs)
+    loss = distillation_loss(outputs, targets) + compactness_loss(outputs)
+
+    # backward pass
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+def train_steps(args, teacher, resnet18, optimizer, model_name, device):
+    '''Train for max_steps steps on a PatchStream of the training images,
+    the teacher is saved every checkpoint_steps steps and after the last
+    one when the mean loss over these steps decreased. With target_bank,
+    the stream gives the patches and targets of build_target_bank.py,
+    resnet18 is not used.'''
+    if args.target_bank:
+        path = target_bank_dir(args.dataset, args.patch_size, args.image_size)
+        bank = TargetBank(path, dataset=args.dataset, patch_size=args.patch_size, image_size=args.image_size,
+                          resnet18=resnet18_fingerprint(args.dataset))
+        print(f"Number of training patches: {len(bank)}, read from {path}")
+        # batches of the bank are used as they are
+        stream = PatchStream(bank, lambda batch: batch, args.batch_size, args.queue_size)
+    else:
+        bank = load_image_bank(args)
+        print(f"Number of training samples: {len(bank)}, {bank.numel() / 2**20:.0f} MiB in RAM")
+        augment = partial(teacher_augmentation, patch_size=args.patch_size, n_patches=args.patches_per_image)
+        stream = PatchStream(bank, augment, max(1, args.batch_size // args.patches_per_image), args.queue_size)
+
+    min_running_loss = np.inf
+    running_loss, n_steps = 0.0, 0
+    try:
+        for step in tqdm(range(args.max_steps)):
+            if args.target_bank:
+                inputs, targets = (x.to(device) for x in next(stream))
+            else:
+                inputs = next(stream).to(device)
+                targets = patch_targets(resnet18, inputs)
+            running_loss += train_step(teacher, optimizer, inputs, targets)
+            n_steps += 1
+
+            # print stats, the last interval may be shorter so the
+            # intervals are compared by their mean loss
+            if (step + 1) % args.checkpoint_steps == 0 or step + 1 == args.max_steps:
+                running_loss /= n_steps
+                print(f"Step {step+1} \t mean loss: {running_loss}")
+
+                if running_loss < min_running_loss:
+                    torch.save(teacher.state_dict(), model_name)
+                    print(f"Loss decreased: {min_running_loss} -> {running_loss}.")
+                    print(f"Model saved to {model_name}.")
+
+                min_running_loss = min(min_running_loss, running_loss)
+                running_loss, n_steps = 0.0, 0
+    finally:
+        stream.close()
+
+
+def train(args):
+    if args.target_bank and not args.max_steps:
+        raise ValueError('The target bank is trained on a patch stream, --max_steps is required.')
+
+    # Choosing device 
+    device = torch.device("cuda:0" if args.gpus else "cpu")
+    print(f'Device used: {device}')
+
+    # Pretrained network for knowledge distillation, the target bank holds its outputs
+    resnet18 = None if args.target_bank else load_resnet18(args.dataset, device)
 
     # Teacher network
     teacher = AnomalyNet.create((args.patch_size, args.patch_size))
@@ -80,24 +312,43 @@ def train(args):
                            lr=args.learning_rate,
                            weight_decay=args.weight_decay)
 
+    if args.max_steps:
+        train_steps(args, teacher, resnet18, optimizer, model_name, device)
+        return
+
     # Load training data
-    dataset = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
-                             transform=transforms.Compose([
-                                transforms.Resize((args.image_size, args.image_size)),
-                                transforms.RandomCrop((args.patch_size, args.patch_size)),
-                                transforms.RandomHorizontalFlip(),
-                                transforms.RandomVerticalFlip(),
-                                transforms.RandomRotation(180),
-                                transforms.ToTensor(),
-                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]),
-                             type='train')
+    resize = transforms.Resize((args.image_size, args.image_size))
+    if args.batch_augment:
+        # uint8 images, augmented by batch in the training loop
+        dataset = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
+                                 transform=transforms.Compose([resize, transforms.Lambda(to_rgb), transforms.PILToTensor()]),
+                                 gt_transform=None,
+                                 packed_size=args.image_size if args.packed else None,
+                                 type='train')
+    elif args.patches_per_image > 1:
+        # images decoded and resized once for all their patches
+        dataset = MultiPatchDataset(AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
+                                                   transform=resize,
+                                                   gt_transform=None,
+                                                   packed_size=args.image_size if args.packed else None,
+                                                   type='train'),
+                                    patch_transform(args.patch_size),
+                                    args.patches_per_image)
+    else:
+        dataset = AnomalyDataset(root_dir=f'/content/drive/MyDrive/data/{args.dataset}',
+                                 transform=transforms.Compose([
+                                    resize,
+                                    patch_transform(args.patch_size)]),
+                                 packed_size=args.image_size if args.packed else None,
+                                 type='train')
     
     print(f"Number of training samples: {len(dataset)}", "dataset", dataset)
 
     dataloader = DataLoader(dataset, 
-                            batch_size=args.batch_size,
+                            batch_size=max(1, args.batch_size // args.patches_per_image),
                             shuffle=True, 
-                            num_workers=args.num_workers)
+                            num_workers=args.num_workers,
+                            persistent_workers=args.num_workers > 0)
     
 
     # training
@@ -106,21 +357,12 @@ def train(args):
         running_loss = 0.0
 
         for i, batch in tqdm(enumerate(dataloader)):
-            # zero the parameters gradient
-            optimizer.zero_grad()
-
-            # forward pass
-            inputs = batch['image'].to(device)
-            with torch.no_grad():
-                targets = rearrange(resnet18(inputs), 'b vec h w -> b (vec h w)') # h=w=1
-                #targets = torch.squeeze(resnet18(inputs))
-            outputs = teacher(inputs)
-            loss = distillation_loss(outputs, targets) + compactness_loss(outputs)
-
-            # backward pass
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
+            # (b, n_patches, 3, p, p) batches are flattened
+            if args.batch_augment:
+                inputs = teacher_augmentation(batch['image'].to(device), args.patch_size, args.patches_per_image)
+            else:
+                inputs = batch['image'].flatten(0, -4).to(device)
+            running_loss += train_step(teacher, optimizer, inputs, patch_targets(resnet18, inputs))
 
         # print stats
         print(f"Epoch {epoch+1}, iter {i+1} \t loss: {running_loss}")
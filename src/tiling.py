@@ -0,0 +1,151 @@
+'''
+Tiled dense feature extraction.
+
+A descriptor of fdfe only depends on the patch centered on its pixel, so a
+large image can be processed as overlapping tiles: each output tile is
+extended by the receptive field halo of the patch CNN, processed, and the
+halo is cropped away. The stitched maps equal the ones of a single fdfe call
+on the whole image, while the peak memory only depends on the tile size.
+The same holds for tiles covering only a region of interest of the image.
+'''
+
+import torch
+from AnomalyNet import conv_layers
+
+
+ELEMENT_SIZE = 4  # float32
+DESCRIPTOR_SIZE = 512
+
+
+def halo(net):
+    '''Context (top, bottom, left, right) needed around a tile.'''
+    pad = net.multiPoolPrepare
+    return int(pad.pad_top), int(pad.pad_bottom), int(pad.pad_left), int(pad.pad_right)
+
+
+def fdfe_memory(net, h, w):
+    '''Estimated peak memory (bytes) of net.fdfe on one image of size (h, w).'''
+    top, bottom, left, right = halo(net)
+    H, W = h + top + bottom, w + left + right
+    B, C = 1, 3
+    peak = 0
+    for i, conv in enumerate(conv_layers(net)):
+        kH, kW = conv.kernel_size
+        H, W = H - kH + 1, W - kW + 1
+        # input, convolution output and activation
+        peak = max(peak, B * C * (H + kH - 1) * (W + kW - 1) + 2 * B * conv.out_channels * H * W)
+        C = conv.out_channels
+        if i < net.n_pools:
+            # input, every window and the shifted outputs
+            peak = max(peak, 3 * B * C * H * W)
+            B, H, W = 4 * B, H // 2, W // 2
+    # unwrapped features, decode output and activation
+    peak = max(peak, 2 * B * C * H * W + 2 * h * w * DESCRIPTOR_SIZE * getattr(net, 'n_nets', 1))
+    return peak * ELEMENT_SIZE
+
+
+def score_memory(nets, n_students, h, w, batch_size=1):
+    '''Estimated peak memory (bytes) of scoring a batch of (h, w) tiles.
+    On top of the fdfe of the largest network, the normalized teacher
+    output, the running sum of the students outputs and the output of
+    the current student are alive at once (the outputs of an ensemble
+    are counted by its fdfe).'''
+    descriptors = (min(n_students, 2) + 1) * h * w * DESCRIPTOR_SIZE * ELEMENT_SIZE
+    return batch_size * (descriptors + max(fdfe_memory(net, h, w) for net in nets))
+
+
+def tile_size(nets, n_students, imH, imW, max_memory, batch_size=1):
+    '''Largest square output tile, a multiple of the pooling stride, whose
+    scoring fits within max_memory bytes.'''
+    stride = 2**nets[0].n_pools
+    top, bottom, left, right = halo(nets[0])
+    size = max(imH, imW) + (-max(imH, imW)) % stride
+    while size >= stride:
+        h, w = min(size, imH) + top + bottom, min(size, imW) + left + right
+        if score_memory(nets, n_students, h, w, batch_size) <= max_memory:
+            return size
+        size -= stride
+    raise ValueError(f'A memory budget of {max_memory / 2**20:.0f} MiB is too small '
+                     f'to score even a {stride}x{stride} tile.')
+
+
+def window(net, imH, imW, r0, r1, c0, c1):
+    '''Input window of the output tile [r0, r1) x [c0, c1), see tiles.'''
+    top, bottom, left, right = halo(net)
+    a, b = max(0, r0 - top), min(imH, r1 + bottom)
+    c, d = max(0, c0 - left), min(imW, c1 + right)
+    return (slice(a, b), slice(c, d)), \
+           (slice(r0, r1), slice(c0, c1)), \
+           (slice(r0 - a, r1 - a), slice(c0 - c, c1 - c))
+
+
+def tiles(net, imH, imW, size):
+    '''Split an (imH, imW) output into tiles of at most (size, size).
+    Yields the input window (rows, cols) to feed to fdfe with its halo,
+    the output tile (rows, cols) and where it lies in the window output.'''
+    for r0 in range(0, imH, size):
+        for c0 in range(0, imW, size):
+            yield window(net, imH, imW, r0, min(r0 + size, imH), c0, min(c0 + size, imW))
+
+
+def roi_mask(roi, imH, imW):
+    '''(imH, imW) boolean mask of a region of interest given as a mask
+    or as a list of (x0, y0, x1, y1) boxes, x1 and y1 excluded.'''
+    if torch.is_tensor(roi):
+        if roi.shape != (imH, imW):
+            raise ValueError(f'ROI mask of shape {tuple(roi.shape)} for ({imH}, {imW}) images.')
+        return roi.bool()
+    mask = torch.zeros((imH, imW), dtype=torch.bool)
+    for x0, y0, x1, y1 in roi:
+        mask[max(0, y0):max(0, y1), max(0, x0):max(0, x1)] = True
+    return mask
+
+
+def roi_tiles(net, roi, imH, imW, size=None):
+    '''Tiles (see tiles) covering a region of interest (see roi_mask) only.
+    The image is split into (size, size) cells, each cell holding ROI pixels
+    gives the tile of their bounding box. When size is None, a list of boxes
+    gives one tile per box, and a mask is split into cells of twice the
+    receptive field, so that the halo at most doubles the area of a tile.'''
+    if not torch.is_tensor(roi) and size is None:
+        for x0, y0, x1, y1 in roi:
+            r0, r1, c0, c1 = max(0, y0), min(imH, y1), max(0, x0), min(imW, x1)
+            if r0 < r1 and c0 < c1:
+                yield window(net, imH, imW, r0, r1, c0, c1)
+        return
+
+    mask = roi_mask(roi, imH, imW).cpu()
+    if size is None:
+        top, bottom, left, right = halo(net)
+        size = 2 * max(top + bottom, left + right)
+    for r0 in range(0, imH, size):
+        for c0 in range(0, imW, size):
+            rows, cols = torch.nonzero(mask[r0:r0 + size, c0:c0 + size], as_tuple=True)
+            if rows.numel():
+                yield window(net, imH, imW, r0 + int(rows.min()), r0 + int(rows.max()) + 1,
+                             c0 + int(cols.min()), c0 + int(cols.max()) + 1)
+
+
+def image_tiles(inputs, teacher, students, max_memory=None, roi=None):
+    '''Tiles (see tiles) to score a batch of images with a peak memory of
+    about max_memory bytes, students being a list of networks or an ensemble.
+    A single tile covering the images is yielded when max_memory is None.
+    Only the tiles covering roi (see roi_tiles) are yielded when it is given.'''
+    imH, imW = inputs.size(2), inputs.size(3)
+    if max_memory is None:
+        if roi is not None:
+            yield from roi_tiles(teacher, roi, imH, imW)
+            return
+        full = (slice(0, imH), slice(0, imW))
+        yield full, full, full
+        return
+
+    if hasattr(students, 'n_nets'):
+        nets, n_students = [teacher, students], students.n_nets
+    else:
+        nets, n_students = [teacher], len(students)
+    size = tile_size(nets, n_students, imH, imW, max_memory, inputs.size(0))
+    if roi is not None:
+        yield from roi_tiles(teacher, roi, imH, imW, size)
+    else:
+        yield from tiles(teacher, imH, imW, size)
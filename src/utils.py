@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+from AnomalyNet import AnomalyNet, EnsembleAnomalyNet
+from QuantizedAnomalyNet import quantize_net
 
 
 def load_model(model, model_path):
@@ -15,12 +17,78 @@ def load_model(model, model_path):
         print(f'Initilialisation of random weights for {model_name}.')
 
 
+def quantized_model_path(model_path):
+    '''INT8 checkpoint saved next to a model, eg: teacher_65_net_int8.pt'''
+    return model_path.replace('.pt', '_int8.pt')
+
+
+def load_models(dataset, patch_size, n_students, device, fused_students=False, quantized=False):
+    '''Trained teacher and students of a dataset, ready for inference.
+    The students are packed in an EnsembleAnomalyNet when fused_students.
+    The INT8 checkpoints of quantize_models.py are loaded when quantized,
+    they only run on CPU.'''
+    if quantized:
+        if fused_students:
+            raise ValueError('The INT8 students are separate networks, they cannot be fused.')
+        return load_quantized_models(dataset, patch_size, n_students)
+
+    # Teacher network
+    teacher = AnomalyNet.create((patch_size, patch_size))
+    teacher.eval().to(device)
+
+    # Load teacher model
+    load_model(teacher, f'../model/{dataset}/teacher_{patch_size}_net.pt')
+
+    # Students networks
+    students = [AnomalyNet.create((patch_size, patch_size)) for _ in range(n_students)]
+    students = [student.eval().to(device) for student in students]
+
+    # Loading students models
+    for i in range(n_students):
+        model_name = f'../model/{dataset}/student_{patch_size}_net_{i}.pt'
+        load_model(students[i], model_name)
+
+    if fused_students:
+        students = EnsembleAnomalyNet.from_nets(students).eval().to(device)
+
+    return teacher, students
+
+
+def load_quantized_models(dataset, patch_size, n_students):
+    model_paths = [f'../model/{dataset}/teacher_{patch_size}_net.pt'] + \
+                  [f'../model/{dataset}/student_{patch_size}_net_{i}.pt' for i in range(n_students)]
+    nets = []
+    for model_path in model_paths:
+        checkpoint = torch.load(quantized_model_path(model_path), map_location='cpu')
+        # the weights are packed for the engine they were quantized with
+        torch.backends.quantized.engine = checkpoint['engine']
+        net = quantize_net(AnomalyNet.create((patch_size, patch_size)).eval())
+        net.load_state_dict(checkpoint['state_dict'])
+        print(f'Loading of {quantized_model_path(model_path).split("/")[-1]} succesful.')
+        nets.append(net)
+    return nets[0], nets[1:]
+
+
+def params_to(params, device):
+    '''Calibration parameters (nested dict of tensors) moved to device.'''
+    if isinstance(params, dict):
+        return {key: params_to(value, device) for key, value in params.items()}
+    return torch.as_tensor(params).to(device)
+
+
+def autocast(device, precision):
+    '''Autocast context of a --precision option: bf16 runs the convolutions
+    and linear layers in bfloat16 (AMX/AVX512-BF16 on CPU), fp32 disables it.'''
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
 def increment_mean_and_var(mu_N, var_N, N, batch):
     '''Increment value of mean and variance based on
        current mean, var and new batch
     '''
-    # batch: (batch, h, w, vector)
-    B = batch.size()[0] # batch size
+    # batch: (batch, h, w, vector), statistics are accumulated in fp32
+    batch = batch.float()
+    B = batch.size(0) * batch.size(1) * batch.size(2) # batch size * pixels
     # we want a descriptor vector -> mean over batch and pixels
     mu_B = torch.mean(batch, dim=[0,1,2])
     S_B = B * torch.var(batch, dim=[0,1,2], unbiased=False) 